@@ -28,12 +28,150 @@ bootstrap section (e.g. username `admin`, password `admin`) to log in.
 
 """
 
+import csv
+import io
+import math
+import re
+from dataclasses import dataclass, field
+from functools import partial
+
+import pandas as pd
 import streamlit as st  # type: ignore
-from typing import List, Dict, Any
+from streamlit.errors import StreamlitAPIException
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from datetime import date  # restrict birth date range and default values
 
-from database import DatabaseManager
+from database import (
+    DUPLICATE_KEY,
+    BulkOp,
+    BulkWriteError,
+    DatabaseManager,
+    DuplicateKeyError,
+    PyMongoError,
+    ReturnDocument,
+)
 import auth
+import reports
+
+
+# Display labels for the list views, keyed by document field (in column order)
+EMPLOYEE_COLUMNS = {
+    "MANV": "MANV",
+    "HO": "Họ",
+    "TEN": "Tên",
+    "DIACHI": "Địa chỉ",
+    "NGAYSINH": "Ngày sinh",
+    "LUONG": "Lương",
+    "MACN": "Chi nhánh",
+}
+WAREHOUSE_COLUMNS = {"MAKHO": "MAKHO", "TENKHO": "Tên kho", "DIACHI": "Địa chỉ", "MACN": "Chi nhánh"}
+MATERIAL_COLUMNS = {"MAHANG": "MAHANG", "TENHANG": "Tên hàng", "DVT": "Đơn vị tính", "SOLUONG": "Số lượng"}
+ORDER_COLUMNS = {"MasoDDH": "Mã đơn", "NGAY": "Ngày", "NhaCC": "Nhà CC", "MANV": "Mã NV", "MAKHO": "Mã kho"}
+RECEIPT_COLUMNS = {"MAPN": "Mã PN", "NGAY": "Ngày", "MasoDDH": "Mã đơn", "MANV": "Mã NV", "MAKHO": "Mã kho"}
+ISSUE_COLUMNS = {"MAPX": "Mã PX", "NGAY": "Ngày", "HOTENKH": "Họ tên KH", "MANV": "Mã NV", "MAKHO": "Mã kho"}
+DETAIL_COLUMNS = {"MAHANG": "Mã hàng", "TENHANG": "Tên hàng", "SOLUONG": "Số lượng", "DONGIA": "Đơn giá"}
+
+# Keys typed into forms (MANV, MAKHO, MAHANG, MasoDDH, MAPN, MAPX) after _code
+CODE_PATTERN = re.compile(r"^[A-Z0-9]{1,16}$")
+
+# List views fetch one window of this many rows at a time
+PAGE_SIZE = 50
+
+# Selectbox code lists are cleared on every write that changes them, so the
+# TTL only bounds staleness from writes made by other processes
+CODES_TTL = 300
+
+# Dashboard greeting per role; {branch} is the user's branch code
+ROLE_DESCRIPTIONS = {
+    "Congty": (
+        "Bạn đang đăng nhập với quyền Công Ty. Bạn có thể xem dữ liệu của "
+        "hai chi nhánh, tạo tài khoản mới và xem báo cáo."
+    ),
+    "Chinhanh": (
+        "Bạn đang đăng nhập với quyền Chi Nhánh {branch}. "
+        "Bạn có thể quản lý dữ liệu của chi nhánh này và tạo tài khoản cho "
+        "nhân viên và người dùng."
+    ),
+    "User": (
+        "Bạn đang đăng nhập với quyền User của chi nhánh {branch}. "
+        "Bạn chỉ có quyền cập nhật dữ liệu của chi nhánh này."
+    ),
+}
+
+# Sidebar menu per role; account creation is for managers, reports for the company
+BASE_MENU = ("Tổng quan", "Nhân viên", "Kho", "Vật tư", "Đơn hàng", "Phiếu nhập/xuất")
+MENU_BY_ROLE = {
+    "Congty": BASE_MENU + ("Tạo tài khoản", "Báo cáo"),
+    "Chinhanh": BASE_MENU + ("Tạo tài khoản",),
+    "User": BASE_MENU,
+}
+
+
+def _records_frame(records: Any, columns: Dict[str, str]) -> pd.DataFrame:
+    """Build a display DataFrame from projected documents in one pass."""
+    return pd.DataFrame.from_records(records, columns=list(columns)).rename(columns=columns)
+
+
+def _count(col: Any, query: Dict[str, Any]) -> int:
+    """Count matching documents, using collection metadata when unfiltered."""
+    return col.count_documents(query) if query else col.estimated_document_count()
+
+
+def _find_page(
+    col: Any, query: Dict[str, Any], projection: Dict[str, Any], key: str, page: int
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """Return the total row count and one ``PAGE_SIZE`` window sorted by ``key``.
+
+    Unfiltered totals come from the collection metadata rather than a count.
+    """
+    total = _count(col, query)
+    cursor = col.find(query, projection).sort(key, 1).skip((page - 1) * PAGE_SIZE).limit(PAGE_SIZE)
+    return total, list(cursor)
+
+
+def _paged_table(
+    key: str,
+    fetch: Callable[[int], Tuple[int, List[Dict[str, Any]]]],
+    columns: Dict[str, str],
+    empty_message: str,
+) -> None:
+    """Render one page of a list view and, for long lists, a page selector.
+
+    ``fetch(page)`` returns ``(total, rows)``; the current page lives in
+    session state under ``key`` and is pulled back in range when rows were
+    deleted since it was chosen.
+    """
+    page = st.session_state.get(key, 1)
+    total, rows = fetch(page)
+    pages = max(1, -(-total // PAGE_SIZE))
+    if page > pages:
+        page = st.session_state[key] = pages
+        total, rows = fetch(page)
+    if not rows:
+        st.info(empty_message)
+        return
+    st.dataframe(_records_frame(rows, columns), hide_index=True)
+    if pages > 1:
+        st.number_input("Trang", min_value=1, max_value=pages, step=1, key=key)
+        st.caption(f"Tổng cộng {total} dòng, {pages} trang")
+
+
+def _code(value: str) -> str:
+    """Normalize a key typed into a form (MANV, MAKHO, MAHANG, ...)."""
+    return value.strip().upper()
+
+
+def _txt(value: str) -> str:
+    """Normalize free text typed into a form."""
+    return value.strip()
+
+
+def _valid_code(code: str, label: str) -> bool:
+    """Check a normalized key before any write; report it under the form if invalid."""
+    if CODE_PATTERN.match(code):
+        return True
+    st.error(f"{label} chỉ gồm chữ cái không dấu và chữ số, tối đa 16 ký tự")
+    return False
 
 
 def bootstrap_users(dbm: DatabaseManager) -> None:
@@ -48,34 +186,233 @@ def bootstrap_users(dbm: DatabaseManager) -> None:
     * ``user1`` – a ``User`` role for branch ``CN1`` with limited rights.
 
     This helper is idempotent: it only runs when there are no existing users.
+    The accounts are written with a single ``insert_many`` round trip.
     """
     users_col = dbm.get_collection(None, "users")
-    if users_col.count_documents({}) == 0:
-        auth.create_user(dbm, "admin", "admin", "CongTy")
-        auth.create_user(dbm, "cn1_mgr", "password", "ChiNhanh", branch="CN1")
-        auth.create_user(dbm, "cn2_mgr", "password", "ChiNhanh", branch="CN2")
-        auth.create_user(dbm, "user1", "password", "User", branch="CN1")
+    if users_col.find_one({}, {"_id": 1}) is None:
+        users_col.insert_many(
+            [
+                auth.build_user("admin", "admin", "CongTy"),
+                auth.build_user("cn1_mgr", "password", "ChiNhanh", branch="CN1"),
+                auth.build_user("cn2_mgr", "password", "ChiNhanh", branch="CN2"),
+                auth.build_user("user1", "password", "User", branch="CN1"),
+            ],
+            ordered=False,
+        )
 
 
-def main() -> None:
-    # Configure page and session
-    st.set_page_config(page_title="Quản lý nhập/xuất hàng hóa", page_icon="📦", layout="wide")
+@st.cache_resource
+def get_dbm() -> DatabaseManager:
+    """Return the process-wide database manager.
 
-    # Initialize database manager and seed data if necessary
+    Streamlit reruns the whole script on every widget interaction, so the
+    MongoDB clients, indexes and demo data are initialized once here and the
+    same ``DatabaseManager`` (and its connection pools) is shared by every
+    session.
+    """
     dbm = DatabaseManager()
     dbm.init_schema()
     dbm.seed_demo_data()
     bootstrap_users(dbm)
+    return dbm
+
+
+def get_col(branch: Any, name: str) -> Any:
+    """Collection handle for a branch from the shared database manager.
+
+    ``DatabaseManager.get_collection`` memoizes handles itself, so this is a
+    plain dictionary hit after the first call.
+    """
+    return get_dbm().get_collection(branch, name)
+
+
+@st.cache_resource
+def start_cache_invalidation() -> None:
+    """Clear cached reads as soon as their collections change, once per process.
+
+    Writes made through this app clear the affected caches themselves; the
+    change stream watchers also catch writes from other processes. Where
+    change streams are unavailable the cache TTLs bound the staleness.
+    """
+    dbm = get_dbm()
+    dependents = {
+        "DatHang": (fetch_orders, order_codes, dashboard_counts),
+        "PhieuNhap": (fetch_receipts, receipt_codes, dashboard_counts),
+        "PhieuXuat": (fetch_issues, issue_codes, dashboard_counts),
+        "Inventory": (fetch_stock,),
+        "Nhanvien": (fetch_employees, employee_codes, dashboard_counts),
+        "Kho": (fetch_warehouses, warehouse_codes, dashboard_counts),
+        "Vattu": (dashboard_counts,),
+    }
+
+    def on_change(collection_name: str) -> None:
+        dbm.invalidate_ref(collection_name)
+        if collection_name in {"PhieuNhap", "PhieuXuat"}:
+            reports.invalidate()
+        for cached in dependents[collection_name]:
+            cached.clear()
+
+    branch_collections = ["DatHang", "PhieuNhap", "PhieuXuat", "Inventory"]
+    dbm.watch_changes(dbm.db_server1, branch_collections, on_change)
+    dbm.watch_changes(dbm.db_server2, branch_collections, on_change)
+    dbm.watch_changes(dbm.db_server3, ["Nhanvien", "Kho", "Vattu"], on_change)
+
+
+def _scope_query(branch: Any, role: str) -> Dict[str, Any]:
+    """Return the branch filter applied to shared collections for a role."""
+    return {"MACN": branch} if branch and role != "Congty" else {}
+
+
+@st.cache_data(ttl=60)
+def fetch_employees(branch: Any, role: str, page: int = 1) -> Tuple[int, List[Dict[str, Any]]]:
+    """Total and one page of employees visible to the given branch/role (cached for 60 s)."""
+    nhanvien_col = get_col(None, "Nhanvien")
+    projection = {"_id": 0, "MANV": 1, "HO": 1, "TEN": 1, "DIACHI": 1, "NGAYSINH": 1, "LUONG": 1, "MACN": 1}
+    return _find_page(nhanvien_col, _scope_query(branch, role), projection, "MANV", page)
+
+
+@st.cache_data(ttl=60)
+def fetch_warehouses(branch: Any, role: str, page: int = 1) -> Tuple[int, List[Dict[str, Any]]]:
+    """Total and one page of warehouses visible to the given branch/role (cached for 60 s)."""
+    kho_col = get_col(None, "Kho")
+    projection = {"_id": 0, "MAKHO": 1, "TENKHO": 1, "DIACHI": 1, "MACN": 1}
+    return _find_page(kho_col, _scope_query(branch, role), projection, "MAKHO", page)
+
+
+def fetch_materials() -> List[Dict[str, Any]]:
+    """All materials, from the manager's reference cache (see ``get_ref``).
+
+    The rows are copied because the cached list is shared by every session.
+    """
+    fields = ("MAHANG", "TENHANG", "DVT")
+    return [{f: vt[f] for f in fields if f in vt} for vt in get_dbm().get_ref("Vattu")]
+
+
+@st.cache_data(ttl=60)
+def fetch_orders(branch: str, page: int = 1) -> Tuple[int, List[Dict[str, Any]]]:
+    """Total and one page of purchase orders (DatHang) of a branch (cached for 60 s)."""
+    projection = {"_id": 0, "MasoDDH": 1, "NGAY": 1, "NhaCC": 1, "MANV": 1, "MAKHO": 1}
+    return _find_page(get_col(branch, "DatHang"), {}, projection, "MasoDDH", page)
+
+
+@st.cache_data(ttl=60)
+def fetch_receipts(branch: str, page: int = 1) -> Tuple[int, List[Dict[str, Any]]]:
+    """Total and one page of goods receipts (PhieuNhap) of a branch (cached for 60 s)."""
+    projection = {"_id": 0, "MAPN": 1, "NGAY": 1, "MasoDDH": 1, "MANV": 1, "MAKHO": 1}
+    return _find_page(get_col(branch, "PhieuNhap"), {}, projection, "MAPN", page)
+
+
+@st.cache_data(ttl=60)
+def fetch_issues(branch: str, page: int = 1) -> Tuple[int, List[Dict[str, Any]]]:
+    """Total and one page of goods issues (PhieuXuat) of a branch (cached for 60 s)."""
+    projection = {"_id": 0, "MAPX": 1, "NGAY": 1, "HOTENKH": 1, "MANV": 1, "MAKHO": 1}
+    return _find_page(get_col(branch, "PhieuXuat"), {}, projection, "MAPX", page)
+
+
+@st.cache_data(ttl=30)
+def fetch_stock(branches: Tuple[Any, ...]) -> Dict[str, int]:
+    """Total inventory per material over the given branches (cached for 30 s)."""
+    pipeline = [{"$group": {"_id": "$MAHANG", "SOLUONG": {"$sum": "$SOLUONG"}}}]
+    totals: Dict[str, int] = {}
+    for b in branches:
+        for row in get_col(b, "Inventory").aggregate(pipeline):
+            totals[row["_id"]] = totals.get(row["_id"], 0) + row["SOLUONG"]
+    return totals
+
+
+@st.cache_data(ttl=60)
+def dashboard_counts(branch: Any, role: str) -> Dict[str, int]:
+    """Overview counts per collection for a branch/role (cached for 60 s).
+
+    The counts span all three servers and do not depend on each other, so
+    they are issued concurrently. The company sees both branches summed.
+    """
+    dbm = get_dbm()
+    if role == "Congty":
+        scope, branches = {}, ("CN1", "CN2")
+    else:
+        # A user without a branch sees no shared rows and server2's documents
+        scope, branches = {"MACN": branch}, ("CN1" if branch == "CN1" else "CN2",)
+    calls = {
+        "Nhanvien": partial(_count, get_col(None, "Nhanvien"), scope),
+        "Kho": partial(_count, get_col(None, "Kho"), scope),
+        "Vattu": partial(_count, get_col(None, "Vattu"), {}),
+    }
+    for b in branches:
+        for name in ("DatHang", "PhieuNhap", "PhieuXuat"):
+            calls[f"{name}:{b}"] = partial(_count, get_col(b, name), {})
+    results = dbm.gather(calls)
+    counts = {name: results[name] for name in ("Nhanvien", "Kho", "Vattu")}
+    for name in ("DatHang", "PhieuNhap", "PhieuXuat"):
+        counts[name] = sum(results[f"{name}:{b}"] for b in branches)
+    return counts
+
+
+@st.cache_data(ttl=CODES_TTL)
+def employee_codes(branch: str) -> List[str]:
+    """Sorted MANV values of a branch, for selectboxes."""
+    return sorted(get_col(None, "Nhanvien").distinct("MANV", {"MACN": branch}))
+
+
+@st.cache_data(ttl=CODES_TTL)
+def warehouse_codes(branch: str) -> List[str]:
+    """Sorted MAKHO values of a branch, for selectboxes."""
+    return sorted(get_col(None, "Kho").distinct("MAKHO", {"MACN": branch}))
+
+
+def material_codes() -> List[str]:
+    """All MAHANG values, sorted, for selectboxes."""
+    return sorted(vt["MAHANG"] for vt in get_dbm().get_ref("Vattu"))
+
+
+@st.cache_data(ttl=CODES_TTL)
+def order_codes(branch: str) -> List[str]:
+    """Sorted MasoDDH values of a branch's orders, for selectboxes."""
+    return sorted(get_col(branch, "DatHang").distinct("MasoDDH"))
+
+
+@st.cache_data(ttl=CODES_TTL)
+def receipt_codes(branch: str) -> List[str]:
+    """Sorted MAPN values of a branch's goods receipts, for selectboxes."""
+    return sorted(get_col(branch, "PhieuNhap").distinct("MAPN"))
+
+
+@st.cache_data(ttl=CODES_TTL)
+def issue_codes(branch: str) -> List[str]:
+    """Sorted MAPX values of a branch's goods issues, for selectboxes."""
+    return sorted(get_col(branch, "PhieuXuat").distinct("MAPX"))
+
+
+def _with_material_names(details: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Attach TENHANG to detail lines from the cached material catalogue.
+
+    Detail collections live on the branch servers while Vattu lives on
+    server3, so a server-side ``$lookup`` cannot join them; the catalogue is
+    already cached, which makes the join free on the client.
+    """
+    names = {vt["MAHANG"]: vt.get("TENHANG") for vt in fetch_materials()}
+    for d in details:
+        d["TENHANG"] = names.get(d.get("MAHANG"))
+    return details
+
+
+def main() -> None:
+    # Configure page and session
+    st.set_page_config(page_title="Quản lý nhập/xuất hàng hóa", page_icon="📦", layout="wide")
+
+    # Shared database manager, initialized and seeded once per process
+    dbm = get_dbm()
+    start_cache_invalidation()
 
-    if "user" not in st.session_state:
-        st.session_state.user = None
+    if "ctx" not in st.session_state:
+        st.session_state.ctx = None
 
     def logout() -> None:
         """Clear the logged‑in user and force a rerun."""
-        st.session_state.user = None
+        st.session_state.ctx = None
         st.rerun()
 
-    if st.session_state.user is None:
+    if st.session_state.ctx is None:
         # Show login form
         st.title("Đăng nhập hệ thống")
         with st.form("login_form", clear_on_submit=False):
@@ -85,7 +422,7 @@ def main() -> None:
             if submitted:
                 user_doc = auth.authenticate(dbm, username, password)
                 if user_doc:
-                    st.session_state.user = user_doc
+                    st.session_state.ctx = auth.UserCtx.from_user(user_doc)
                     st.success("Đăng nhập thành công!")
                     st.rerun()
                 else:
@@ -93,355 +430,231 @@ def main() -> None:
         st.stop()
 
     # At this point the user is authenticated
-    user = st.session_state.user
-    st.sidebar.write(f"Xin chào, **{user['username']}**")
-    st.sidebar.write(f"Quyền: **{user['role']}**")
-    if user.get("branch"):
-        st.sidebar.write(f"Chi nhánh: **{user['branch']}**")
+    ctx: auth.UserCtx = st.session_state.ctx
+    st.sidebar.write(f"Xin chào, **{ctx.username}**")
+    st.sidebar.write(f"Quyền: **{ctx.role}**")
+    if ctx.branch:
+        st.sidebar.write(f"Chi nhánh: **{ctx.branch}**")
     st.sidebar.button("Đăng xuất", on_click=logout)
 
-    # Determine accessible branch (None means view all)
-    user_role = user["role"].capitalize()
-    user_branch = user.get("branch")
-
     # Navigation menu
-    menu_options: List[str] = []
-    menu_options.append("Tổng quan")
-    # Employees accessible to ChiNhanh and CongTy
-    menu_options.append("Nhân viên")
-    menu_options.append("Kho")
-    menu_options.append("Vật tư")
-    menu_options.append("Đơn hàng")
-    menu_options.append("Phiếu nhập/xuất")
-    if user_role == "Congty" or user_role == "Chinhanh":
-        menu_options.append("Tạo tài khoản")
-    if user_role == "Congty":
-        menu_options.append("Báo cáo")
-
+    menu_options = MENU_BY_ROLE.get(ctx.role, BASE_MENU)
     selection = st.sidebar.selectbox("Chức năng", menu_options)
+    PAGES[selection](dbm, ctx)
 
-    if selection == "Tổng quan":
-        show_dashboard(dbm, user)
-    elif selection == "Nhân viên":
-        show_employees(dbm, user)
-    elif selection == "Kho":
-        show_warehouses(dbm, user)
-    elif selection == "Vật tư":
-        show_materials(dbm, user)
-    elif selection == "Đơn hàng":
-        show_orders(dbm, user)
-    elif selection == "Phiếu nhập/xuất":
-        show_receipts(dbm, user)
-    elif selection == "Tạo tài khoản":
-        show_create_account(dbm, user)
-    elif selection == "Báo cáo":
-        show_reports(dbm, user)
-
-
-def show_dashboard(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
+
+def show_dashboard(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
     """Display a simple overview for the current user."""
     st.header("Tổng quan")
-    role = user["role"].capitalize()
-    if role == "Congty":
-        st.write(
-            "Bạn đang đăng nhập với quyền Công Ty. Bạn có thể xem dữ liệu của "
-            "hai chi nhánh, tạo tài khoản mới và xem báo cáo."
-        )
-    elif role == "Chinhanh":
-        st.write(
-            f"Bạn đang đăng nhập với quyền Chi Nhánh {user.get('branch')}. "
-            "Bạn có thể quản lý dữ liệu của chi nhánh này và tạo tài khoản cho "
-            "nhân viên và người dùng."
-        )
-    else:
-        st.write(
-            f"Bạn đang đăng nhập với quyền User của chi nhánh {user.get('branch')}. "
-            "Bạn chỉ có quyền cập nhật dữ liệu của chi nhánh này."
-        )
+    st.markdown(ROLE_DESCRIPTIONS.get(ctx.role, ROLE_DESCRIPTIONS["User"]).format(branch=ctx.branch))
 
     # Show dashboard metrics for a quick overview
-    # Compute counts for employees, warehouses, materials and transactions.
-    branch = user.get("branch")
     st.subheader("Thống kê")
-    # Counts for shared collections
-    nhanvien_col = dbm.get_collection(None, "Nhanvien")
-    kho_col = dbm.get_collection(None, "Kho")
-    vattu_col = dbm.get_collection(None, "Vattu")
-    if role == "Congty":
-        # Company role sees aggregated counts across branches
-        total_employees = nhanvien_col.count_documents({})
-        total_warehouses = kho_col.count_documents({})
-        total_materials = vattu_col.count_documents({})
-        # Orders and receipts across both servers
-        total_orders = dbm.db_server1["DatHang"].count_documents({}) + dbm.db_server2["DatHang"].count_documents({})
-        total_receipts = dbm.db_server1["PhieuNhap"].count_documents({}) + dbm.db_server2["PhieuNhap"].count_documents({})
-        total_issues = dbm.db_server1["PhieuXuat"].count_documents({}) + dbm.db_server2["PhieuXuat"].count_documents({})
-    else:
-        # Branch or user role sees counts for their branch only
-        branch_filter = {"MACN": branch}
-        total_employees = nhanvien_col.count_documents(branch_filter)
-        total_warehouses = kho_col.count_documents(branch_filter)
-        total_materials = vattu_col.count_documents({})  # shared table
-        if branch == "CN1":
-            total_orders = dbm.db_server1["DatHang"].count_documents({})
-            total_receipts = dbm.db_server1["PhieuNhap"].count_documents({})
-            total_issues = dbm.db_server1["PhieuXuat"].count_documents({})
-        else:
-            total_orders = dbm.db_server2["DatHang"].count_documents({})
-            total_receipts = dbm.db_server2["PhieuNhap"].count_documents({})
-            total_issues = dbm.db_server2["PhieuXuat"].count_documents({})
+    counts = dashboard_counts(ctx.branch, ctx.role)
     # Display metrics in columns
     col1, col2, col3, col4, col5 = st.columns(5)
-    col1.metric("Nhân viên", total_employees)
-    col2.metric("Kho", total_warehouses)
-    col3.metric("Vật tư", total_materials)
-    col4.metric("Đơn đặt hàng", total_orders)
+    col1.metric("Nhân viên", counts["Nhanvien"])
+    col2.metric("Kho", counts["Kho"])
+    col3.metric("Vật tư", counts["Vattu"])
+    col4.metric("Đơn đặt hàng", counts["DatHang"])
     # Combine receipts and issues into one metric for brevity
-    col5.metric("Phiếu nhập/xuất", total_receipts + total_issues)
+    col5.metric("Phiếu nhập/xuất", counts["PhieuNhap"] + counts["PhieuXuat"])
 
 
-def show_employees(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
-    """Employee management page."""
-    st.header("Danh sách nhân viên")
-    branch = user.get("branch")
-    role = user["role"].capitalize()
-    nhanvien_col = dbm.get_collection(None, "Nhanvien")
-    # Fetch employees of this branch only
-    query = {"MACN": branch} if branch and role != "Congty" else {}
-    employees = list(nhanvien_col.find(query))
-    # Show table
-    if employees:
-        # Remove internal id for display
-        df = [
-            {
-                "MANV": nv.get("MANV"),
-                "Họ": nv.get("HO"),
-                "Tên": nv.get("TEN"),
-                "Địa chỉ": nv.get("DIACHI"),
-                "Ngày sinh": nv.get("NGAYSINH"),
-                "Lương": nv.get("LUONG"),
-                "Chi nhánh": nv.get("MACN"),
-            }
-            for nv in employees
-        ]
-        st.dataframe(df)
-    else:
-        st.info("Chưa có nhân viên nào trong danh sách.")
-
-    # Only Congty or ChiNhanh roles can modify employees
-    if role in {"Congty", "Chinhanh"}:
-        st.subheader("Thêm/Sửa nhân viên")
-        with st.form("employee_form"):
-            manv = st.text_input("Mã nhân viên")
-            ho = st.text_input("Họ")
-            ten = st.text_input("Tên")
-            diachi = st.text_input("Địa chỉ")
-            # Restrict birth date between 1 Jan 1965 and 31 Dec 2004
-            ngaysinh = st.date_input(
-                "Ngày sinh",
-                value=date(1990, 1, 1),
-                min_value=date(1965, 1, 1),
-                max_value=date(2004, 12, 31),
-            )
-            luong = st.number_input("Lương", min_value=0.0, step=100.0)
-            # Branch selection depends on role
-            macn_options = ["CN1", "CN2"]
-            selected_branch = (
-                st.selectbox("Chi nhánh", macn_options) if role == "Congty" else branch
-            )
-            submit = st.form_submit_button("Lưu")
-            if submit:
-                # Convert date to ISO string
-                ngaysinh_str = ngaysinh.isoformat()
-                doc = {
-                    "MANV": manv.strip().upper(),
-                    "HO": ho.strip(),
-                    "TEN": ten.strip(),
-                    "DIACHI": diachi.strip(),
-                    "NGAYSINH": ngaysinh_str,
-                    "LUONG": float(luong),
-                    "MACN": selected_branch,
-                }
-                # Upsert (insert or update) employee
-                existing = nhanvien_col.find_one({"MANV": doc["MANV"]})
-                if existing:
-                    nhanvien_col.update_one({"MANV": doc["MANV"]}, {"$set": doc})
-                    st.success("Cập nhật nhân viên thành công")
-                else:
-                    nhanvien_col.insert_one(doc)
-                    st.success("Thêm nhân viên mới thành công")
-                st.rerun()
+@dataclass(frozen=True)
+class FieldSpec:
+    """One input of a reference-table form.
 
-        # Delete employee section
-        st.subheader("Xóa nhân viên")
-        manv_to_delete = st.text_input("Nhập mã nhân viên cần xóa")
-        if st.button("Xóa"):
-            if nhanvien_col.delete_one({"MANV": manv_to_delete.strip().upper()}).deleted_count:
-                st.success("Đã xóa nhân viên")
-            else:
-                st.error("Không tìm thấy nhân viên hoặc lỗi khi xóa")
-            st.rerun()
+    ``widget`` selects how the value is entered and normalized: ``"code"``
+    (upper-cased key), ``"text"``, ``"date"`` (stored as an ISO string),
+    ``"money"`` or ``"branch"`` (a selectbox for the company, otherwise the
+    user's own branch). ``options`` are passed through to the widget.
+    """
 
+    name: str
+    label: str
+    widget: str = "text"
+    options: Dict[str, Any] = field(default_factory=dict)
 
-def show_warehouses(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
-    """Warehouse management page."""
-    st.header("Danh sách kho")
-    branch = user.get("branch")
-    role = user["role"].capitalize()
-    kho_col = dbm.get_collection(None, "Kho")
-    query = {"MACN": branch} if branch and role != "Congty" else {}
-    warehouses = list(kho_col.find(query))
-    if warehouses:
-        df = [
-            {
-                "MAKHO": k.get("MAKHO"),
-                "Tên kho": k.get("TENKHO"),
-                "Địa chỉ": k.get("DIACHI"),
-                "Chi nhánh": k.get("MACN"),
-            }
-            for k in warehouses
-        ]
-        st.dataframe(df)
-    else:
-        st.info("Chưa có kho nào trong danh sách.")
-
-    if role in {"Congty", "Chinhanh"}:
-        st.subheader("Thêm/Sửa kho")
-        with st.form("warehouse_form"):
-            makho = st.text_input("Mã kho")
-            tenkho = st.text_input("Tên kho")
-            diachi = st.text_input("Địa chỉ")
-            selected_branch = (
-                st.selectbox("Chi nhánh", ["CN1", "CN2"]) if role == "Congty" else branch
-            )
-            submit = st.form_submit_button("Lưu")
-            if submit:
-                doc = {
-                    "MAKHO": makho.strip().upper(),
-                    "TENKHO": tenkho.strip(),
-                    "DIACHI": diachi.strip(),
-                    "MACN": selected_branch,
-                }
-                existing = kho_col.find_one({"MAKHO": doc["MAKHO"]})
-                if existing:
-                    kho_col.update_one({"MAKHO": doc["MAKHO"]}, {"$set": doc})
-                    st.success("Cập nhật kho thành công")
-                else:
-                    kho_col.insert_one(doc)
-                    st.success("Thêm kho mới thành công")
-                st.rerun()
 
-        st.subheader("Xóa kho")
-        makho_to_delete = st.text_input("Nhập mã kho cần xóa")
-        if st.button("Xóa kho"):
-            if kho_col.delete_one({"MAKHO": makho_to_delete.strip().upper()}).deleted_count:
-                st.success("Đã xóa kho")
-            else:
-                st.error("Không tìm thấy kho hoặc lỗi khi xóa")
-            st.rerun()
+@dataclass(frozen=True)
+class CrudSpec:
+    """Declarative description of a reference-table management page."""
 
+    collection: str
+    key: str
+    title: str
+    noun: str
+    fields: Tuple[FieldSpec, ...]
+    columns: Dict[str, str]
+    # Total and one page of visible rows for the logged-in user, and the
+    # caches a write invalidates
+    rows: Callable[[auth.UserCtx, int], Tuple[int, List[Dict[str, Any]]]]
+    caches: Tuple[Any, ...]
 
-def show_materials(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
-    """Materials management page."""
-    st.header("Danh mục vật tư")
-    role = user["role"].capitalize()
-    vattu_col = dbm.get_collection(None, "Vattu")
-    materials = list(vattu_col.find())
-    if materials:
-        data_rows = []
-        # Compute quantity per item depending on user role
-        user_branch = user.get("branch")
-        for vt in materials:
-            mahang = vt.get("MAHANG")
-            # Calculate total quantity of this material in inventory
-            total_qty = 0
-            # If company role, sum quantities across both branches
-            if role == "Congty":
-                for b in ["CN1", "CN2"]:
-                    inventory_col = dbm.get_collection(b, "Inventory")
-                    for doc in inventory_col.find({"MAHANG": mahang}):
-                        total_qty += doc.get("SOLUONG", 0)
+    @property
+    def key_label(self) -> str:
+        """Form label of the key field."""
+        return next(f.label for f in self.fields if f.name == self.key)
+
+
+def _material_rows(ctx: auth.UserCtx, page: int) -> Tuple[int, List[Dict[str, Any]]]:
+    """One page of materials with the stock total visible to the user merged in.
+
+    The whole catalogue is cached anyway (detail lines join names from it),
+    so the page is sliced from it instead of queried.
+    """
+    # Company users see stock summed over both branches, others their own
+    branches = ("CN1", "CN2") if ctx.is_congty else (ctx.branch,)
+    stock = fetch_stock(branches)
+    materials = fetch_materials()
+    window = materials[(page - 1) * PAGE_SIZE : page * PAGE_SIZE]
+    return len(materials), [{**vt, "SOLUONG": stock.get(vt.get("MAHANG"), 0)} for vt in window]
+
+
+EMPLOYEE_SPEC = CrudSpec(
+    collection="Nhanvien",
+    key="MANV",
+    title="Danh sách nhân viên",
+    noun="nhân viên",
+    fields=(
+        FieldSpec("MANV", "Mã nhân viên", "code"),
+        FieldSpec("HO", "Họ"),
+        FieldSpec("TEN", "Tên"),
+        FieldSpec("DIACHI", "Địa chỉ"),
+        # Restrict birth date between 1 Jan 1965 and 31 Dec 2004
+        FieldSpec(
+            "NGAYSINH",
+            "Ngày sinh",
+            "date",
+            {"value": date(1990, 1, 1), "min_value": date(1965, 1, 1), "max_value": date(2004, 12, 31)},
+        ),
+        FieldSpec("LUONG", "Lương", "money"),
+        FieldSpec("MACN", "Chi nhánh", "branch"),
+    ),
+    columns=EMPLOYEE_COLUMNS,
+    rows=lambda ctx, page: fetch_employees(ctx.branch, ctx.role, page),
+    caches=(fetch_employees, employee_codes, dashboard_counts),
+)
+WAREHOUSE_SPEC = CrudSpec(
+    collection="Kho",
+    key="MAKHO",
+    title="Danh sách kho",
+    noun="kho",
+    fields=(
+        FieldSpec("MAKHO", "Mã kho", "code"),
+        FieldSpec("TENKHO", "Tên kho"),
+        FieldSpec("DIACHI", "Địa chỉ"),
+        FieldSpec("MACN", "Chi nhánh", "branch"),
+    ),
+    columns=WAREHOUSE_COLUMNS,
+    rows=lambda ctx, page: fetch_warehouses(ctx.branch, ctx.role, page),
+    caches=(fetch_warehouses, warehouse_codes, dashboard_counts),
+)
+MATERIAL_SPEC = CrudSpec(
+    collection="Vattu",
+    key="MAHANG",
+    title="Danh mục vật tư",
+    noun="vật tư",
+    fields=(
+        FieldSpec("MAHANG", "Mã hàng", "code"),
+        FieldSpec("TENHANG", "Tên hàng"),
+        FieldSpec("DVT", "Đơn vị tính"),
+    ),
+    columns=MATERIAL_COLUMNS,
+    rows=_material_rows,
+    caches=(dashboard_counts,),
+)
+
+
+def _field_input(spec_field: FieldSpec, ctx: auth.UserCtx) -> Any:
+    """Render the widget for one form field and return its normalized value."""
+    widget = spec_field.widget
+    if widget == "branch":
+        if ctx.is_congty:
+            return st.selectbox(spec_field.label, ["CN1", "CN2"], **spec_field.options)
+        return ctx.branch
+    if widget == "date":
+        return st.date_input(spec_field.label, **spec_field.options).isoformat()
+    if widget == "money":
+        return float(st.number_input(spec_field.label, min_value=0.0, step=100.0, **spec_field.options))
+    value = st.text_input(spec_field.label, **spec_field.options)
+    return _code(value) if widget == "code" else _txt(value)
+
+
+def render_crud(dbm: DatabaseManager, ctx: auth.UserCtx, spec: CrudSpec) -> None:
+    """List, add/edit and delete page for a reference table on server3."""
+    st.header(spec.title)
+    _paged_table(
+        f"page:{spec.collection}",
+        lambda page: spec.rows(ctx, page),
+        spec.columns,
+        f"Chưa có {spec.noun} nào trong danh sách.",
+    )
+
+    # Only Congty or ChiNhanh roles can modify reference data
+    if not ctx.can_edit:
+        return
+    col = get_col(None, spec.collection)
+
+    st.subheader(f"Thêm/Sửa {spec.noun}")
+    with st.form(f"{spec.collection}_form"):
+        doc = {f.name: _field_input(f, ctx) for f in spec.fields}
+        if st.form_submit_button("Lưu") and _valid_code(doc[spec.key], spec.key_label):
+            # Upsert (insert or update) in a single round-trip
+            result = col.update_one({spec.key: doc[spec.key]}, {"$set": doc}, upsert=True)
+            if result.upserted_id is not None:
+                st.success(f"Thêm {spec.noun} mới thành công")
             else:
-                # branch or user role: use inventory of the current branch
-                inventory_col = dbm.get_collection(user_branch, "Inventory")
-                for doc in inventory_col.find({"MAHANG": mahang}):
-                    total_qty += doc.get("SOLUONG", 0)
-            data_rows.append({
-                "MAHANG": mahang,
-                "Tên hàng": vt.get("TENHANG"),
-                "Đơn vị tính": vt.get("DVT"),
-                "Số lượng": total_qty,
-            })
-        st.dataframe(data_rows)
-    else:
-        st.info("Chưa có vật tư nào trong danh sách.")
-
-    if role in {"Congty", "Chinhanh"}:
-        st.subheader("Thêm/Sửa vật tư")
-        with st.form("material_form"):
-            mahang = st.text_input("Mã hàng")
-            tenhang = st.text_input("Tên hàng")
-            dvt = st.text_input("Đơn vị tính")
-            submit = st.form_submit_button("Lưu")
-            if submit:
-                doc = {
-                    "MAHANG": mahang.strip().upper(),
-                    "TENHANG": tenhang.strip(),
-                    "DVT": dvt.strip(),
-                }
-                existing = vattu_col.find_one({"MAHANG": doc["MAHANG"]})
-                if existing:
-                    vattu_col.update_one({"MAHANG": doc["MAHANG"]}, {"$set": doc})
-                    st.success("Cập nhật vật tư thành công")
-                else:
-                    vattu_col.insert_one(doc)
-                    st.success("Thêm vật tư mới thành công")
-                st.rerun()
+                st.success(f"Cập nhật {spec.noun} thành công")
+            dbm.invalidate_ref(spec.collection)
+            for cache in spec.caches:
+                cache.clear()
+            st.rerun()
 
-        st.subheader("Xóa vật tư")
-        mahang_to_delete = st.text_input("Nhập mã vật tư cần xóa")
-        if st.button("Xóa vật tư"):
-            if vattu_col.delete_one({"MAHANG": mahang_to_delete.strip().upper()}).deleted_count:
-                st.success("Đã xóa vật tư")
+    st.subheader(f"Xóa {spec.noun}")
+    # A form so typing the code does not rerun the page until submitted
+    with st.form(f"{spec.collection}_delete_form", clear_on_submit=True):
+        code_to_delete = st.text_input(f"Nhập mã {spec.noun} cần xóa")
+        if st.form_submit_button(f"Xóa {spec.noun}") and _valid_code(
+            _code(code_to_delete), spec.key_label
+        ):
+            if col.delete_one({spec.key: _code(code_to_delete)}).deleted_count:
+                st.success(f"Đã xóa {spec.noun}")
             else:
-                st.error("Không tìm thấy vật tư hoặc lỗi khi xóa")
+                st.error(f"Không tìm thấy {spec.noun} hoặc lỗi khi xóa")
+            dbm.invalidate_ref(spec.collection)
+            for cache in spec.caches:
+                cache.clear()
             st.rerun()
 
 
-def show_orders(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
+def show_employees(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
+    """Employee management page."""
+    render_crud(dbm, ctx, EMPLOYEE_SPEC)
+
+
+def show_warehouses(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
+    """Warehouse management page."""
+    render_crud(dbm, ctx, WAREHOUSE_SPEC)
+
+
+def show_materials(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
+    """Materials management page."""
+    render_crud(dbm, ctx, MATERIAL_SPEC)
+
+
+def show_orders(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
     """Orders management page (Đơn hàng)."""
     st.header("Đơn đặt hàng")
-    role = user["role"].capitalize()
-    branch = user.get("branch")
-    # Determine collection and underlying client based on branch
-    dathang_col = dbm.get_collection(branch, "DatHang") if branch else None
-    ctddh_col = dbm.get_collection(branch, "CTDDH") if branch else None
-    # Select the correct MongoClient so we can start a session for writes
-    client = None
-    if branch == "CN1":
-        client = dbm.client_server1
-    elif branch == "CN2":
-        client = dbm.client_server2
-
-    if role == "Congty":
+    branch = ctx.branch
+    if ctx.is_congty:
         st.info("Chức năng này hiện chưa hỗ trợ cho quyền Công Ty.")
         return
     # Show list of orders for the user's branch
-    orders = list(dathang_col.find({})) if dathang_col is not None else []
-    if orders:
-        df = [
-            {
-                "Mã đơn": dh.get("MasoDDH"),
-                "Ngày": dh.get("NGAY"),
-                "Nhà CC": dh.get("NhaCC"),
-                "Mã NV": dh.get("MANV"),
-                "Mã kho": dh.get("MAKHO"),
-            }
-            for dh in orders
-        ]
-        st.dataframe(df)
-    else:
-        st.info("Chưa có đơn hàng nào.")
+    _paged_table(
+        "page:DatHang", lambda page: fetch_orders(branch, page), ORDER_COLUMNS, "Chưa có đơn hàng nào."
+    )
 
     # Only branch managers/users can add orders
     st.subheader("Tạo đơn đặt hàng mới")
@@ -450,536 +663,640 @@ def show_orders(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
         ngay = st.date_input("Ngày lập đơn")
         nhacc = st.text_input("Nhà cung cấp")
         # Employee must be within branch
-        nhanvien_col = dbm.get_collection(None, "Nhanvien")
-        nhanvien_list = list(nhanvien_col.find({"MACN": branch}))
-        manv_options = [nv["MANV"] for nv in nhanvien_list]
+        manv_options = employee_codes(branch)
         manv = st.selectbox("Nhân viên lập", manv_options) if manv_options else ""
-        kho_col = dbm.get_collection(None, "Kho")
-        kho_list = list(kho_col.find({"MACN": branch}))
-        makho_options = [k["MAKHO"] for k in kho_list]
+        makho_options = warehouse_codes(branch)
         makho = st.selectbox("Kho nhập", makho_options) if makho_options else ""
         submit = st.form_submit_button("Lưu đơn hàng")
-        if submit:
+        if submit and _valid_code(_code(masoddh), "Mã đơn đặt hàng"):
             doc = {
-                "MasoDDH": masoddh.strip().upper(),
+                "MasoDDH": _code(masoddh),
                 "NGAY": ngay.isoformat(),
-                "NhaCC": nhacc.strip(),
+                "NhaCC": _txt(nhacc),
                 "MANV": manv,
                 "MAKHO": makho,
             }
-            if dathang_col.find_one({"MasoDDH": doc["MasoDDH"]}):
+            # The unique index on MasoDDH rejects duplicates, so no pre-check
+            try:
+                _save_order_atomic(dbm, branch, doc)
+                st.success("Đã thêm đơn hàng")
+                fetch_orders.clear()
+                order_codes.clear()
+                dashboard_counts.clear()
+                st.rerun()
+            except DuplicateKeyError:
                 st.error("Mã đơn đặt hàng đã tồn tại")
-            else:
-                # Perform the insert within a transaction if the backend supports it
-                if client is not None and hasattr(client, "start_session"):
-                    session = None
-                    try:
-                        session = client.start_session()
-                        session.start_transaction()
-                        dathang_col.insert_one(doc, session=session)
-                        # chỗ thêm các insert/update liên quan (nếu có) cũng dùng session
-                        session.commit_transaction()
-                        st.success("Đã thêm đơn hàng")
-                        st.rerun()
-                    except Exception as e:
-                        # Fallback nếu server không hỗ trợ transaction (code 20 / IllegalOperation)
-                        try:
-                            if session:
-                                try:
-                                    session.abort_transaction()
-                                except Exception:
-                                    pass
-                            dathang_col.insert_one(doc)  # insert thường, không transaction
-                            st.success("Đã thêm đơn hàng (không dùng transaction)")
-                            st.rerun()
-                        except Exception as inner_e:
-                            st.error(f"Lỗi khi thêm đơn hàng: {inner_e}")
-                    finally:
-                        if session:
-                            session.end_session()
-                else:
-                    try:
-                        dathang_col.insert_one(doc)
-                        st.success("Đã thêm đơn hàng")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Lỗi khi thêm đơn hàng: {e}")
+            except Exception as e:
+                st.error(f"Lỗi khi thêm đơn hàng: {e}")
 
 
     st.subheader("Chi tiết đơn hàng")
-    if orders:
-        selected_order = st.selectbox(
-            "Chọn đơn hàng để cập nhật chi tiết",
-            [o["MasoDDH"] for o in orders],
-        )
+    order_options = order_codes(branch)
+    if order_options:
+        selected_order = st.selectbox("Chọn đơn hàng để cập nhật chi tiết", order_options)
     else:
         selected_order = None
 
     if selected_order:
-        order_doc = dathang_col.find_one({"MasoDDH": selected_order})
-        details = list(ctddh_col.find({"MasoDDH": selected_order}))
-        if details:
-            df = [
-                {
-                    "Mã hàng": d.get("MAHANG"),
-                    "Số lượng": d.get("SOLUONG"),
-                    "Đơn giá": d.get("DONGIA"),
-                }
-                for d in details
-            ]
-            st.dataframe(df)
-        else:
-            st.info("Đơn hàng chưa có chi tiết")
+        _order_details(dbm, branch, selected_order)
+    else:
+        st.info("Chọn đơn hàng để quản lý chi tiết")
 
-        inventory_col = dbm.get_collection(branch, "Inventory")
-        vattu_col = dbm.get_collection(None, "Vattu")
-        mahang_opts = [vt["MAHANG"] for vt in vattu_col.find()]
-
-        st.markdown("**Thêm chi tiết**")
-        with st.form("ctddh_add_form"):
-            mahang = st.selectbox("Mã hàng", mahang_opts)
-            soluong = st.number_input("Số lượng", min_value=1, step=1)
-            dongia = st.number_input("Đơn giá", min_value=0.0, step=1000.0)
-            submit_ct = st.form_submit_button("Lưu chi tiết")
-            if submit_ct:
-                existing = ctddh_col.find_one({"MasoDDH": selected_order, "MAHANG": mahang})
-                if existing:
-                    st.error("Mã hàng đã tồn tại trong đơn")
-                else:
-                    inv = inventory_col.find_one({"MAKHO": order_doc["MAKHO"], "MAHANG": mahang})
-                    available = inv.get("SOLUONG", 0) if inv else 0
-                    if soluong > available:
-                        st.error(f"Tồn kho không đủ (còn {available})")
-                    else:
-                        ctddh_col.insert_one({
-                            "MasoDDH": selected_order,
-                            "MAHANG": mahang,
-                            "SOLUONG": soluong,
-                            "DONGIA": dongia,
-                        })
-                        inventory_col.update_one(
-                            {"MAKHO": order_doc["MAKHO"], "MAHANG": mahang},
-                            {"$inc": {"SOLUONG": -soluong}},
-                        )
-                        st.success("Đã thêm chi tiết")
-                        st.rerun()
-
-        if details:
-            st.markdown("**Sửa/Xóa chi tiết**")
-            edit_mahang = st.selectbox(
-                "Chọn chi tiết",
-                [d["MAHANG"] for d in details],
-                key="ctddh_edit_select",
+
+def _save_order_atomic(dbm: DatabaseManager, branch: str, order_doc: Dict[str, Any]) -> None:
+    """Insert an order header through the branch server's transaction path.
+
+    Detail lines are added afterwards from the line editor, where
+    :func:`_save_detail_edits` writes them together with their guarded
+    Inventory decrements in one transaction.
+    """
+    dathang_col = dbm.get_collection(branch, "DatHang")
+    dbm.run_transaction(branch, lambda session: dathang_col.insert_one(order_doc, session=session))
+
+
+def _rerun_fragment() -> None:
+    """Rerun only the calling fragment after a write.
+
+    Fragment-scoped reruns are only allowed while the fragment itself is
+    being rerun; when it ran as part of a full page run, rerun the page.
+    """
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+def _detail_editor_config() -> Dict[str, Any]:
+    """Column setup of the CTDDH/CTPN line editors."""
+    return {
+        "MAHANG": st.column_config.SelectboxColumn(
+            DETAIL_COLUMNS["MAHANG"], options=material_codes(), required=True
+        ),
+        "TENHANG": st.column_config.TextColumn(DETAIL_COLUMNS["TENHANG"], disabled=True),
+        "SOLUONG": st.column_config.NumberColumn(
+            DETAIL_COLUMNS["SOLUONG"], min_value=1, step=1, required=True
+        ),
+        "DONGIA": st.column_config.NumberColumn(
+            DETAIL_COLUMNS["DONGIA"], min_value=0.0, step=1000.0, default=0.0
+        ),
+    }
+
+
+def _editor_rows(frame: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Turn the rows of a line editor back into detail documents.
+
+    Rows without a material are dropped; a missing quantity is an error.
+    """
+    rows = []
+    for rec in frame.to_dict("records"):
+        if pd.isna(rec.get("MAHANG")) or not rec["MAHANG"]:
+            continue
+        if pd.isna(rec.get("SOLUONG")):
+            raise ValueError(f"Thiếu số lượng cho mã hàng {rec['MAHANG']}")
+        dongia = rec.get("DONGIA")
+        rows.append({
+            "MAHANG": rec["MAHANG"],
+            "SOLUONG": int(rec["SOLUONG"]),
+            "DONGIA": 0.0 if pd.isna(dongia) else float(dongia),
+        })
+    return rows
+
+
+def _parse_pasted_lines(text: str) -> List[Dict[str, Any]]:
+    """Parse pasted ``MAHANG, SOLUONG[, DONGIA]`` rows into detail lines.
+
+    Raises:
+        ValueError: A row has the wrong number of fields, a quantity that is
+            not a positive whole number, a price that is not a finite
+            number of at least 0 or an unknown material.
+    """
+    rows = []
+    # csv keeps every field, so a row with too many is reported instead of
+    # being shifted or cut short
+    for number, fields in enumerate(csv.reader(io.StringIO(text), skipinitialspace=True), start=1):
+        if not any(f.strip() for f in fields):
+            continue
+        if len(fields) not in (2, 3):
+            raise ValueError(
+                f"Dòng {number}: cần mã hàng, số lượng và đơn giá (không bắt buộc), "
+                f"nhận được {len(fields)} giá trị"
             )
-            edit_doc = next(d for d in details if d["MAHANG"] == edit_mahang)
-            with st.form("ctddh_edit_form"):
-                new_qty = st.number_input(
-                    "Số lượng", min_value=1, value=edit_doc["SOLUONG"], step=1
-                )
-                new_price = st.number_input(
-                    "Đơn giá", min_value=0.0, value=float(edit_doc.get("DONGIA", 0)), step=1000.0
-                )
-                update_btn = st.form_submit_button("Cập nhật")
-                if update_btn:
-                    diff = new_qty - edit_doc["SOLUONG"]
-                    inv = inventory_col.find_one({"MAKHO": order_doc["MAKHO"], "MAHANG": edit_mahang})
-                    available = inv.get("SOLUONG", 0) if inv else 0
-                    if diff > 0 and diff > available:
-                        st.error(f"Tồn kho không đủ (còn {available})")
-                    else:
-                        ctddh_col.update_one(
-                            {"MasoDDH": selected_order, "MAHANG": edit_mahang},
-                            {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-                        )
-                        if diff != 0:
-                            inventory_col.update_one(
-                                {"MAKHO": order_doc["MAKHO"], "MAHANG": edit_mahang},
-                                {"$inc": {"SOLUONG": -diff}},
-                            )
-                        st.success("Đã cập nhật")
-                        st.rerun()
+        mahang = _code(fields[0])
+        try:
+            soluong = float(fields[1])
+        except ValueError:
+            soluong = float("nan")
+        if not soluong.is_integer() or soluong < 1:
+            raise ValueError(f"Dòng {number}: số lượng của mã hàng {mahang} phải là số nguyên lớn hơn 0")
+        price = fields[2].strip() if len(fields) == 3 else ""
+        try:
+            dongia = float(price) if price else 0.0
+        except ValueError:
+            dongia = float("nan")
+        if not math.isfinite(dongia) or dongia < 0:
+            raise ValueError(f"Dòng {number}: đơn giá của mã hàng {mahang} không hợp lệ")
+        rows.append({"MAHANG": mahang, "SOLUONG": int(soluong), "DONGIA": dongia})
+    if not rows:
+        raise ValueError("Chưa nhập dòng nào")
+    known = set(material_codes())
+    for row in rows:
+        if row["MAHANG"] not in known:
+            raise ValueError(f"Mã hàng {row['MAHANG']} không tồn tại")
+    return rows
+
+
+def _save_detail_edits(
+    dbm: DatabaseManager,
+    branch: str,
+    detail_name: str,
+    key: Dict[str, Any],
+    makho: str,
+    before: List[Dict[str, Any]],
+    after: List[Dict[str, Any]],
+    sign: int,
+) -> None:
+    """Apply the edited detail lines of one document in a single transaction.
+
+    ``before`` and ``after`` hold the lines (``MAHANG``, ``SOLUONG``,
+    ``DONGIA``) as loaded and as edited. The difference becomes one bulk
+    write of inserts, updates and deletes on the detail collection. Stock
+    taken from Inventory is decremented line by line with a ``$gte`` guard
+    in the filter, and stock given back is sent as one bulk write of
+    ``$inc`` operations. ``sign`` is the stock
+    movement per unit ordered, issued or received: ``-1`` for CTDDH and
+    CTPX, ``1`` for CTPN.
+
+    Raises:
+        ValueError: A material appears twice, or a warehouse does not hold
+            enough stock for the requested increase.
+        DuplicateKeyError: Another editor saved a line for one of the new
+            materials first.
+    """
+    old = {d["MAHANG"]: d for d in before}
+    new: Dict[str, Dict[str, Any]] = {}
+    for row in after:
+        if row["MAHANG"] in new:
+            raise ValueError(f"Mã hàng {row['MAHANG']} bị trùng")
+        new[row["MAHANG"]] = row
+
+    # Inserts go first: they are the only operations that can fail on a
+    # duplicate line, and the ordered batch stops there
+    inserts: List[BulkOp] = []
+    detail_ops: List[BulkOp] = []
+    deltas: Dict[str, int] = {}
+    for mahang, row in new.items():
+        line_key = {**key, "MAHANG": mahang}
+        values = {"SOLUONG": row["SOLUONG"], "DONGIA": row["DONGIA"]}
+        if mahang not in old:
+            inserts.append(BulkOp.insert({**line_key, **values}))
+        elif any(old[mahang].get(f) != v for f, v in values.items()):
+            detail_ops.append(BulkOp.update(line_key, {"$set": values}))
+        deltas[mahang] = row["SOLUONG"] - old.get(mahang, {}).get("SOLUONG", 0)
+    for mahang, row in old.items():
+        if mahang not in new:
+            detail_ops.append(BulkOp.delete({**key, "MAHANG": mahang}))
+            deltas[mahang] = -row["SOLUONG"]
+    detail_ops = inserts + detail_ops
+    moves = {m: sign * d for m, d in deltas.items() if d}
+    taken = {m: qty for m, qty in moves.items() if qty < 0}
+
+    detail_col = dbm.get_collection(branch, detail_name)
+    inventory_col = dbm.get_collection(branch, "Inventory")
+
+    def give_back(materials: List[str], session: Any) -> None:
+        dbm.bulk_write(
+            inventory_col,
+            [BulkOp.update({"MAKHO": makho, "MAHANG": m}, {"$inc": {"SOLUONG": -taken[m]}}) for m in materials],
+            session=session,
+        )
+
+    def write(session: Any) -> None:
+        done: List[str] = []
+        try:
+            for m, qty in taken.items():
+                # Check and decrement in one update; nothing matches when short,
+                # so concurrent editors can never drive the stock negative
+                inv_filter = {"MAKHO": makho, "MAHANG": m}
+                if not inventory_col.update_one(
+                    {**inv_filter, "SOLUONG": {"$gte": -qty}},
+                    {"$inc": {"SOLUONG": qty}},
+                    session=session,
+                ).matched_count:
+                    left = _available(inventory_col, inv_filter, session)
+                    raise ValueError(f"Tồn kho {m} không đủ (còn {left})")
+                done.append(m)
+            try:
+                dbm.bulk_write(detail_col, detail_ops, session=session, ordered=True)
+            except BulkWriteError as exc:
+                failed = exc.details["writeErrors"][0]
+                if session is None:
+                    # The batch stopped at the failure; take back the lines
+                    # inserted before it
+                    applied = [op for op in detail_ops[: failed["index"]] if op.kind == "insert"]
+                    dbm.bulk_write(
+                        detail_col,
+                        [BulkOp.delete({**key, "MAHANG": op.document["MAHANG"]}) for op in applied],
+                    )
+                if failed.get("code") == DUPLICATE_KEY:
+                    mahang = detail_ops[failed["index"]].document["MAHANG"]
+                    raise DuplicateKeyError(f"Mã hàng {mahang} đã tồn tại", DUPLICATE_KEY) from exc
+                raise
+        except Exception:
+            # A transaction is rolled back as a whole; without one, return
+            # the stock already taken before giving up
+            if session is None:
+                give_back(done, None)
+            raise
+        dbm.bulk_write(
+            inventory_col,
+            [
+                BulkOp.update({"MAKHO": makho, "MAHANG": m}, {"$inc": {"SOLUONG": qty}}, upsert=True)
+                for m, qty in moves.items()
+                if qty > 0
+            ],
+            session=session,
+        )
+
+    dbm.run_transaction(branch, write)
 
-            if st.button("Xóa chi tiết", key="delete_ctddh"):
-                ctddh_col.delete_one({"MasoDDH": selected_order, "MAHANG": edit_mahang})
-                inventory_col.update_one(
-                    {"MAKHO": order_doc["MAKHO"], "MAHANG": edit_mahang},
-                    {"$inc": {"SOLUONG": edit_doc["SOLUONG"]}},
-                )
-                st.success("Đã xóa chi tiết")
-                st.rerun()
-    else:
-        st.info("Chọn đơn hàng để quản lý chi tiết")
 
+@st.fragment
+def _order_details(dbm: DatabaseManager, branch: str, selected_order: str) -> None:
+    """Detail lines (CTDDH) of one order.
 
-def show_receipts(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
+    Runs as a fragment so interacting with the detail forms only reruns this
+    block instead of the whole orders page.
+    """
+    dathang_col = get_col(branch, "DatHang")
+    ctddh_col = get_col(branch, "CTDDH")
+    # The header never changes once saved, so read its warehouse only once
+    stash_key = f"od:{selected_order}"
+    if stash_key not in st.session_state:
+        st.session_state[stash_key] = dathang_col.find_one(
+            {"MasoDDH": selected_order}, {"_id": 0, "MAKHO": 1}
+        )
+    order_doc = st.session_state[stash_key]
+    details = _with_material_names(list(
+        ctddh_col.find({"MasoDDH": selected_order}, {"_id": 0, "MAHANG": 1, "SOLUONG": 1, "DONGIA": 1})
+    ))
+    editor_key = f"ctddh_editor_{selected_order}"
+    with st.form("ctddh_editor_form"):
+        if not details:
+            st.info("Đơn hàng chưa có chi tiết")
+        edited = st.data_editor(
+            pd.DataFrame.from_records(details, columns=list(DETAIL_COLUMNS)),
+            column_config=_detail_editor_config(),
+            num_rows="dynamic",
+            hide_index=True,
+            key=editor_key,
+        )
+        submitted = st.form_submit_button("Lưu chi tiết")
+    if submitted:
+        try:
+            _save_detail_edits(
+                dbm, branch, "CTDDH", {"MasoDDH": selected_order},
+                order_doc["MAKHO"], details, _editor_rows(edited), sign=-1,
+            )
+        except DuplicateKeyError:
+            st.error("Mã hàng đã tồn tại trong đơn")
+        except ValueError as e:
+            st.error(str(e))
+        except PyMongoError as e:
+            st.error(f"Lỗi khi lưu chi tiết: {e}")
+        else:
+            st.success("Đã lưu chi tiết")
+            fetch_stock.clear()
+            del st.session_state[editor_key]
+            _rerun_fragment()
+
+
+def show_receipts(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
     """Receipts page for handling PhieuNhap and PhieuXuat."""
     st.header("Phiếu nhập/xuất")
-    role = user["role"].capitalize()
-    branch = user.get("branch")
-    if role == "Congty":
+    branch = ctx.branch
+    if ctx.is_congty:
         st.info("Chức năng này hiện chưa hỗ trợ cho quyền Công Ty.")
         return
-    # Determine collections and underlying client
-    phieunhap_col = dbm.get_collection(branch, "PhieuNhap")
-    ctpn_col = dbm.get_collection(branch, "CTPN")
-    phieuxuat_col = dbm.get_collection(branch, "PhieuXuat")
-    ctpx_col = dbm.get_collection(branch, "CTPX")
-    client = None
-    if branch == "CN1":
-        client = dbm.client_server1
-    elif branch == "CN2":
-        client = dbm.client_server2
-
     # Tabs for import/export
     tab1, tab2 = st.tabs(["Phiếu nhập", "Phiếu xuất"])
     with tab1:
-        st.subheader("Phiếu nhập hàng")
-        pn_list = list(phieunhap_col.find())
-        if pn_list:
-            df = [
-                {
-                    "Mã PN": pn.get("MAPN"),
-                    "Ngày": pn.get("NGAY"),
-                    "Mã đơn": pn.get("MasoDDH"),
-                    "Mã NV": pn.get("MANV"),
-                    "Mã kho": pn.get("MAKHO"),
-                }
-                for pn in pn_list
-            ]
-            st.dataframe(df)
+        _receipts_tab(dbm, branch)
+    with tab2:
+        _issues_tab(dbm, branch)
+
+
+@st.fragment
+def _receipts_tab(dbm: DatabaseManager, branch: str) -> None:
+    """Goods receipt (PhieuNhap) tab; reruns on its own as a fragment."""
+    phieunhap_col = get_col(branch, "PhieuNhap")
+    st.subheader("Phiếu nhập hàng")
+    _paged_table(
+        "page:PhieuNhap", lambda page: fetch_receipts(branch, page), RECEIPT_COLUMNS, "Chưa có phiếu nhập nào"
+    )
+
+    st.subheader("Thêm phiếu nhập")
+    with st.form("phieunhap_form", clear_on_submit=True):
+        mapn = st.text_input("Mã phiếu nhập")
+        ngay = st.date_input("Ngày nhập")
+        # Must pick an existing order
+        maddh_options = order_codes(branch)
+        masoddh = st.selectbox("Chọn đơn đặt hàng", maddh_options) if maddh_options else ""
+        # Employee and warehouse lists
+        manv_options = employee_codes(branch)
+        manv = st.selectbox("Nhân viên nhập", manv_options) if manv_options else ""
+        makho_options = warehouse_codes(branch)
+        makho = st.selectbox("Kho", makho_options) if makho_options else ""
+        submit_pn = st.form_submit_button("Lưu phiếu nhập")
+        if submit_pn and _valid_code(_code(mapn), "Mã phiếu nhập"):
+            doc = {
+                "MAPN": _code(mapn),
+                "NGAY": ngay.isoformat(),
+                "MasoDDH": masoddh,
+                "MANV": manv,
+                "MAKHO": makho,
+            }
+            # The unique index on MAPN rejects duplicates, so no pre-check
+            try:
+                dbm.run_transaction(branch, lambda s: phieunhap_col.insert_one(doc, session=s))
+                st.toast("Đã thêm phiếu nhập", icon="✅")
+                fetch_receipts.clear()
+                reports.invalidate()
+                receipt_codes.clear()
+                dashboard_counts.clear()
+                _rerun_fragment()
+            except DuplicateKeyError:
+                st.error("Mã phiếu nhập đã tồn tại")
+            except Exception as e:
+                st.error(f"Lỗi khi thêm phiếu nhập: {e}")
+
+
+    st.subheader("Chi tiết phiếu nhập")
+    selected_pn = st.selectbox("Chọn phiếu nhập", receipt_codes(branch))
+    if selected_pn:
+        _receipt_details(dbm, branch, selected_pn)
+
+
+@st.fragment
+def _issues_tab(dbm: DatabaseManager, branch: str) -> None:
+    """Goods issue (PhieuXuat) tab; reruns on its own as a fragment."""
+    phieuxuat_col = get_col(branch, "PhieuXuat")
+    st.subheader("Phiếu xuất hàng")
+    _paged_table(
+        "page:PhieuXuat", lambda page: fetch_issues(branch, page), ISSUE_COLUMNS, "Chưa có phiếu xuất nào"
+    )
+    st.subheader("Thêm phiếu xuất")
+    with st.form("phieuxuat_form", clear_on_submit=True):
+        mapx = st.text_input("Mã phiếu xuất")
+        ngay = st.date_input("Ngày xuất")
+        hotenkh = st.text_input("Họ tên khách hàng")
+        manv_options = employee_codes(branch)
+        manv = st.selectbox("Nhân viên xuất", manv_options) if manv_options else ""
+        makho_options = warehouse_codes(branch)
+        makho = st.selectbox("Kho", makho_options) if makho_options else ""
+        submit_px = st.form_submit_button("Lưu phiếu xuất")
+        if submit_px and _valid_code(_code(mapx), "Mã phiếu xuất"):
+            doc = {
+                "MAPX": _code(mapx),
+                "NGAY": ngay.isoformat(),
+                "HOTENKH": _txt(hotenkh),
+                "MANV": manv,
+                "MAKHO": makho,
+            }
+            try:
+                dbm.run_transaction(branch, lambda s: phieuxuat_col.insert_one(doc, session=s))
+                st.toast("Đã thêm phiếu xuất", icon="✅")
+                fetch_issues.clear()
+                reports.invalidate()
+                issue_codes.clear()
+                dashboard_counts.clear()
+                _rerun_fragment()
+            except DuplicateKeyError:
+                st.error("Mã phiếu xuất đã tồn tại")
+            except Exception as e:
+                st.error(f"Lỗi khi thêm phiếu xuất: {e}")
+
+    st.subheader("Chi tiết phiếu xuất")
+    selected_px = st.selectbox("Chọn phiếu xuất", issue_codes(branch))
+    if selected_px:
+        _issue_details(dbm, branch, selected_px)
+
+
+@st.fragment
+def _receipt_details(dbm: DatabaseManager, branch: str, selected_pn: str) -> None:
+    """Detail lines (CTPN) of one goods receipt, rerun as a fragment."""
+    phieunhap_col = get_col(branch, "PhieuNhap")
+    ctpn_col = get_col(branch, "CTPN")
+    stash_key = f"pn:{selected_pn}"
+    if stash_key not in st.session_state:
+        st.session_state[stash_key] = phieunhap_col.find_one(
+            {"MAPN": selected_pn}, {"_id": 0, "MAKHO": 1}
+        )
+    pn_doc = st.session_state[stash_key]
+    details = _with_material_names(list(
+        ctpn_col.find({"MAPN": selected_pn}, {"_id": 0, "MAHANG": 1, "SOLUONG": 1, "DONGIA": 1})
+    ))
+    editor_key = f"ctpn_editor_{selected_pn}"
+    with st.form("ctpn_editor_form"):
+        if not details:
+            st.info("Chưa có chi tiết")
+        edited = st.data_editor(
+            pd.DataFrame.from_records(details, columns=list(DETAIL_COLUMNS)),
+            column_config=_detail_editor_config(),
+            num_rows="dynamic",
+            hide_index=True,
+            key=editor_key,
+        )
+        submitted = st.form_submit_button("Lưu chi tiết nhập")
+    if submitted:
+        try:
+            _save_detail_edits(
+                dbm, branch, "CTPN", {"MAPN": selected_pn},
+                pn_doc["MAKHO"], details, _editor_rows(edited), sign=1,
+            )
+        except DuplicateKeyError:
+            st.error("Mã hàng đã tồn tại trong phiếu")
+        except ValueError as e:
+            st.error(str(e))
+        except PyMongoError as e:
+            st.error(f"Lỗi khi lưu chi tiết: {e}")
         else:
-            st.info("Chưa có phiếu nhập nào")
-
-        st.subheader("Thêm phiếu nhập")
-        with st.form("phieunhap_form", clear_on_submit=True):
-            mapn = st.text_input("Mã phiếu nhập")
-            ngay = st.date_input("Ngày nhập")
-            # Must pick an existing order
-            dathang_col = dbm.get_collection(branch, "DatHang")
-            dh_list = list(dathang_col.find())
-            maddh_options = [dh["MasoDDH"] for dh in dh_list]
-            masoddh = st.selectbox("Chọn đơn đặt hàng", maddh_options) if maddh_options else ""
-            # Employee and warehouse lists
-            nhanvien_col = dbm.get_collection(None, "Nhanvien")
-            manv_options = [nv["MANV"] for nv in nhanvien_col.find({"MACN": branch})]
-            manv = st.selectbox("Nhân viên nhập", manv_options) if manv_options else ""
-            kho_col = dbm.get_collection(None, "Kho")
-            makho_options = [k["MAKHO"] for k in kho_col.find({"MACN": branch})]
-            makho = st.selectbox("Kho", makho_options) if makho_options else ""
-            submit_pn = st.form_submit_button("Lưu phiếu nhập")
-            if submit_pn:
-                doc = {
-                    "MAPN": mapn.strip().upper(),
-                    "NGAY": ngay.isoformat(),
-                    "MasoDDH": masoddh,
-                    "MANV": manv,
-                    "MAKHO": makho,
-                }
-                if phieunhap_col.find_one({"MAPN": doc["MAPN"]}):
-                    st.error("Mã phiếu nhập đã tồn tại")
-                else:
-                    session = None
-                    try:
-                        if client is not None and hasattr(client, "start_session"):
-                            try:
-                                session = client.start_session()
-                                session.start_transaction()
-                                phieunhap_col.insert_one(doc, session=session)
-                                # (Nếu cần) các cập nhật liên quan khác cũng dùng session
-                                session.commit_transaction()
-                                st.toast("Đã thêm phiếu nhập", icon="✅")
-                                st.rerun()
-                            except Exception:
-                                # Server không hỗ trợ transaction → chèn thường
-                                if session:
-                                    try:
-                                        session.abort_transaction()
-                                    except Exception:
-                                        pass
-                                phieunhap_col.insert_one(doc)
-                                st.toast("Đã thêm phiếu nhập (không dùng transaction)", icon="✅")
-                                st.rerun()
-                        else:
-                            phieunhap_col.insert_one(doc)
-                            st.toast("Đã thêm phiếu nhập", icon="✅")
-                            st.rerun()
-                    except Exception as e:
-                        st.error(f"Lỗi khi thêm phiếu nhập: {e}")
-                    finally:
-                        if session:
-                            session.end_session()
-
-
-        st.subheader("Chi tiết phiếu nhập")
-        selected_pn = st.selectbox(
-            "Chọn phiếu nhập", [pn["MAPN"] for pn in pn_list] if pn_list else []
+            st.success("Đã lưu chi tiết")
+            fetch_stock.clear()
+            del st.session_state[editor_key]
+            _rerun_fragment()
+
+
+def _available(inventory_col: Any, inv_filter: Dict[str, Any], session: Any = None) -> int:
+    """Quantity left in one Inventory row (0 when the row does not exist)."""
+    inv = inventory_col.find_one(inv_filter, {"_id": 0, "SOLUONG": 1}, session=session)
+    return inv.get("SOLUONG", 0) if inv else 0
+
+
+@st.fragment
+def _issue_details(dbm: DatabaseManager, branch: str, selected_px: str) -> None:
+    """Detail lines (CTPX) of one goods issue, rerun as a fragment."""
+    phieuxuat_col = get_col(branch, "PhieuXuat")
+    ctpx_col = get_col(branch, "CTPX")
+    inventory_col = get_col(branch, "Inventory")
+    stash_key = f"px:{selected_px}"
+    if stash_key not in st.session_state:
+        st.session_state[stash_key] = phieuxuat_col.find_one(
+            {"MAPX": selected_px}, {"_id": 0, "MAKHO": 1}
         )
-        if selected_pn:
-            pn_doc = phieunhap_col.find_one({"MAPN": selected_pn})
-            details = list(ctpn_col.find({"MAPN": selected_pn}))
-            if details:
-                df = [
-                    {
-                        "Mã hàng": d.get("MAHANG"),
-                        "Số lượng": d.get("SOLUONG"),
-                        "Đơn giá": d.get("DONGIA"),
-                    }
-                    for d in details
-                ]
-                st.dataframe(df)
-            else:
-                st.info("Chưa có chi tiết")
-
-            inventory_col = dbm.get_collection(branch, "Inventory")
-            vattu_col = dbm.get_collection(None, "Vattu")
-            mahang_opts = [vt["MAHANG"] for vt in vattu_col.find()]
-
-            st.markdown("**Thêm chi tiết nhập**")
-            with st.form("ctpn_add_form"):
-                mahang = st.selectbox("Mã hàng", mahang_opts)
-                soluong = st.number_input("Số lượng", min_value=1, step=1)
-                dongia = st.number_input("Đơn giá", min_value=0.0, step=1000.0)
-                submit_ct = st.form_submit_button("Lưu")
-                if submit_ct:
-                    if ctpn_col.find_one({"MAPN": selected_pn, "MAHANG": mahang}):
-                        st.error("Mã hàng đã tồn tại trong phiếu")
-                    else:
-                        ctpn_col.insert_one(
-                            {
-                                "MAPN": selected_pn,
-                                "MAHANG": mahang,
-                                "SOLUONG": soluong,
-                                "DONGIA": dongia,
-                            }
-                        )
-                        inventory_col.update_one(
-                            {"MAKHO": pn_doc["MAKHO"], "MAHANG": mahang},
-                            {"$inc": {"SOLUONG": soluong}},
-                            upsert=True,
-                        )
-                        st.success("Đã thêm chi tiết")
-                        st.rerun()
-
-            if details:
-                st.markdown("**Sửa/Xóa chi tiết nhập**")
-                edit_mahang = st.selectbox(
-                    "Chọn chi tiết nhập",
-                    [d["MAHANG"] for d in details],
-                    key="ctpn_edit_select",
+    px_doc = st.session_state[stash_key]
+    details = _with_material_names(list(
+        ctpx_col.find({"MAPX": selected_px}, {"_id": 0, "MAHANG": 1, "SOLUONG": 1, "DONGIA": 1})
+    ))
+    if details:
+        st.dataframe(_records_frame(details, DETAIL_COLUMNS), hide_index=True)
+    else:
+        st.info("Chưa có chi tiết")
+
+    mahang_opts = material_codes()
+
+    st.markdown("**Thêm chi tiết xuất**")
+    with st.form("ctpx_add_form"):
+        mahang = st.selectbox("Mã hàng", mahang_opts)
+        soluong = st.number_input("Số lượng", min_value=1, step=1)
+        dongia = st.number_input("Đơn giá", min_value=0.0, step=1000.0)
+        submit_ct = st.form_submit_button("Lưu")
+        if submit_ct:
+            inv_filter = {"MAKHO": px_doc["MAKHO"], "MAHANG": mahang}
+            line_key = {"MAPX": selected_px, "MAHANG": mahang}
+
+            def add_line(session: Any) -> Optional[int]:
+                ctpx_col.insert_one(
+                    {**line_key, "SOLUONG": soluong, "DONGIA": dongia},
+                    session=session,
                 )
-                edit_doc = next(d for d in details if d["MAHANG"] == edit_mahang)
-                with st.form("ctpn_edit_form"):
-                    new_qty = st.number_input(
-                        "Số lượng", min_value=1, value=edit_doc["SOLUONG"], step=1
-                    )
-                    new_price = st.number_input(
-                        "Đơn giá", min_value=0.0, value=float(edit_doc.get("DONGIA", 0)), step=1000.0
-                    )
-                    submit_edit = st.form_submit_button("Cập nhật")
-                    if submit_edit:
-                        diff = new_qty - edit_doc["SOLUONG"]
-                        ctpn_col.update_one(
-                            {"MAPN": selected_pn, "MAHANG": edit_mahang},
-                            {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-                        )
-                        if diff != 0:
-                            inventory_col.update_one(
-                                {"MAKHO": pn_doc["MAKHO"], "MAHANG": edit_mahang},
-                                {"$inc": {"SOLUONG": diff}},
-                            )
-                        st.success("Đã cập nhật")
-                        st.rerun()
+                # Take the stock only if enough is left, in the same call
+                if inventory_col.find_one_and_update(
+                    {**inv_filter, "SOLUONG": {"$gte": soluong}},
+                    {"$inc": {"SOLUONG": -soluong}},
+                    projection={"_id": 0, "SOLUONG": 1},
+                    return_document=ReturnDocument.AFTER,
+                    session=session,
+                ) is not None:
+                    return None
+                ctpx_col.delete_one(line_key, session=session)
+                return _available(inventory_col, inv_filter, session)
 
-                if st.button("Xóa chi tiết nhập", key="delete_ctpn"):
-                    ctpn_col.delete_one({"MAPN": selected_pn, "MAHANG": edit_mahang})
-                    inventory_col.update_one(
-                        {"MAKHO": pn_doc["MAKHO"], "MAHANG": edit_mahang},
-                        {"$inc": {"SOLUONG": -edit_doc["SOLUONG"]}},
+            try:
+                short = dbm.run_transaction(branch, add_line)
+            except DuplicateKeyError:
+                st.error("Mã hàng đã tồn tại trong phiếu")
+            except PyMongoError as e:
+                st.error(f"Lỗi khi thêm chi tiết: {e}")
+            else:
+                if short is None:
+                    st.success("Đã thêm chi tiết")
+                    fetch_stock.clear()
+                    _rerun_fragment()
+                st.error(f"Tồn kho không đủ (còn {short})")
+
+    with st.expander("Dán nhiều dòng"):
+        with st.form("ctpx_paste_form", clear_on_submit=True):
+            pasted_text = st.text_area("Mỗi dòng: mã hàng, số lượng, đơn giá")
+            submit_paste = st.form_submit_button("Lưu các dòng")
+        if submit_paste:
+            try:
+                _save_detail_edits(
+                    dbm, branch, "CTPX", {"MAPX": selected_px}, px_doc["MAKHO"],
+                    details, details + _parse_pasted_lines(pasted_text), sign=-1,
+                )
+            except DuplicateKeyError:
+                st.error("Mã hàng đã tồn tại trong phiếu")
+            except ValueError as e:
+                st.error(str(e))
+            except PyMongoError as e:
+                st.error(f"Lỗi khi lưu chi tiết: {e}")
+            else:
+                st.success("Đã thêm chi tiết")
+                fetch_stock.clear()
+                _rerun_fragment()
+
+    if details:
+        details_by_mahang = {d["MAHANG"]: d for d in details}
+        st.markdown("**Sửa/Xóa chi tiết xuất**")
+        edit_mahang = st.selectbox(
+            "Chọn chi tiết xuất", list(details_by_mahang), key="ctpx_edit_select"
+        )
+        edit_doc = details_by_mahang[edit_mahang]
+        with st.form("ctpx_edit_form"):
+            new_qty = st.number_input(
+                "Số lượng", min_value=1, value=edit_doc["SOLUONG"], step=1
+            )
+            new_price = st.number_input(
+                "Đơn giá", min_value=0.0, value=float(edit_doc.get("DONGIA", 0)), step=1000.0
+            )
+            submit_edit = st.form_submit_button("Cập nhật")
+            if submit_edit:
+                diff = new_qty - edit_doc["SOLUONG"]
+                inv_filter = {"MAKHO": px_doc["MAKHO"], "MAHANG": edit_mahang}
+
+                def edit_line(session: Any) -> Optional[int]:
+                    if diff:
+                        # An increase only goes through if enough stock is left
+                        guard = {"SOLUONG": {"$gte": diff}} if diff > 0 else {}
+                        if inventory_col.find_one_and_update(
+                            {**inv_filter, **guard},
+                            {"$inc": {"SOLUONG": -diff}},
+                            projection={"_id": 0, "SOLUONG": 1},
+                            upsert=diff < 0,
+                            return_document=ReturnDocument.AFTER,
+                            session=session,
+                        ) is None:
+                            return _available(inventory_col, inv_filter, session)
+                    ctpx_col.update_one(
+                        {"MAPX": selected_px, "MAHANG": edit_mahang},
+                        {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
+                        session=session,
                     )
-                    st.success("Đã xóa chi tiết")
-                    st.rerun()
+                    return None
 
-    with tab2:
-        st.subheader("Phiếu xuất hàng")
-        px_list = list(phieuxuat_col.find())
-        if px_list:
-            df = [
-                {
-                    "Mã PX": px.get("MAPX"),
-                    "Ngày": px.get("NGAY"),
-                    "Họ tên KH": px.get("HOTENKH"),
-                    "Mã NV": px.get("MANV"),
-                    "Mã kho": px.get("MAKHO"),
-                }
-                for px in px_list
-            ]
-            st.dataframe(df)
-        else:
-            st.info("Chưa có phiếu xuất nào")
-        st.subheader("Thêm phiếu xuất")
-        with st.form("phieuxuat_form", clear_on_submit=True):
-            mapx = st.text_input("Mã phiếu xuất")
-            ngay = st.date_input("Ngày xuất")
-            hotenkh = st.text_input("Họ tên khách hàng")
-            nhanvien_col = dbm.get_collection(None, "Nhanvien")
-            manv_options = [nv["MANV"] for nv in nhanvien_col.find({"MACN": branch})]
-            manv = st.selectbox("Nhân viên xuất", manv_options) if manv_options else ""
-            kho_col = dbm.get_collection(None, "Kho")
-            makho_options = [k["MAKHO"] for k in kho_col.find({"MACN": branch})]
-            makho = st.selectbox("Kho", makho_options) if makho_options else ""
-            submit_px = st.form_submit_button("Lưu phiếu xuất")
-            if submit_px:
-                doc = {
-                    "MAPX": mapx.strip().upper(),
-                    "NGAY": ngay.isoformat(),
-                    "HOTENKH": hotenkh.strip(),
-                    "MANV": manv,
-                    "MAKHO": makho,
-                }
-                if phieuxuat_col.find_one({"MAPX": doc["MAPX"]}):
-                    st.error("Mã phiếu xuất đã tồn tại")
+                try:
+                    short = dbm.run_transaction(branch, edit_line)
+                except PyMongoError as e:
+                    st.error(f"Lỗi khi cập nhật chi tiết: {e}")
                 else:
-                    session = None
-                    try:
-                        if client is not None and hasattr(client, "start_session"):
-                            try:
-                                session = client.start_session()
-                                session.start_transaction()
-                                phieuxuat_col.insert_one(doc, session=session)
-                                # (Nếu cần) các cập nhật liên quan khác cũng dùng session
-                                session.commit_transaction()
-                                st.toast("Đã thêm phiếu xuất", icon="✅")
-                                st.rerun()
-                            except Exception:
-                                if session:
-                                    try:
-                                        session.abort_transaction()
-                                    except Exception:
-                                        pass
-                                phieuxuat_col.insert_one(doc)
-                                st.toast("Đã thêm phiếu xuất (không dùng transaction)", icon="✅")
-                                st.rerun()
-                        else:
-                            phieuxuat_col.insert_one(doc)
-                            st.toast("Đã thêm phiếu xuất", icon="✅")
-                            st.rerun()
-                    except Exception as e:
-                        st.error(f"Lỗi khi thêm phiếu xuất: {e}")
-                    finally:
-                        if session:
-                            session.end_session()
-
-        st.subheader("Chi tiết phiếu xuất")
-        selected_px = st.selectbox(
-            "Chọn phiếu xuất", [px["MAPX"] for px in px_list] if px_list else []
-        )
-        if selected_px:
-            px_doc = phieuxuat_col.find_one({"MAPX": selected_px})
-            details = list(ctpx_col.find({"MAPX": selected_px}))
-            if details:
-                df = [
-                    {
-                        "Mã hàng": d.get("MAHANG"),
-                        "Số lượng": d.get("SOLUONG"),
-                        "Đơn giá": d.get("DONGIA"),
-                    }
-                    for d in details
-                ]
-                st.dataframe(df)
-            else:
-                st.info("Chưa có chi tiết")
-
-            inventory_col = dbm.get_collection(branch, "Inventory")
-            vattu_col = dbm.get_collection(None, "Vattu")
-            mahang_opts = [vt["MAHANG"] for vt in vattu_col.find()]
-
-            st.markdown("**Thêm chi tiết xuất**")
-            with st.form("ctpx_add_form"):
-                mahang = st.selectbox("Mã hàng", mahang_opts)
-                soluong = st.number_input("Số lượng", min_value=1, step=1)
-                dongia = st.number_input("Đơn giá", min_value=0.0, step=1000.0)
-                submit_ct = st.form_submit_button("Lưu")
-                if submit_ct:
-                    if ctpx_col.find_one({"MAPX": selected_px, "MAHANG": mahang}):
-                        st.error("Mã hàng đã tồn tại trong phiếu")
-                    else:
-                        inv = inventory_col.find_one({"MAKHO": px_doc["MAKHO"], "MAHANG": mahang})
-                        available = inv.get("SOLUONG", 0) if inv else 0
-                        if soluong > available:
-                            st.error(f"Tồn kho không đủ (còn {available})")
-                        else:
-                            ctpx_col.insert_one(
-                                {
-                                    "MAPX": selected_px,
-                                    "MAHANG": mahang,
-                                    "SOLUONG": soluong,
-                                    "DONGIA": dongia,
-                                }
-                            )
-                            inventory_col.update_one(
-                                {"MAKHO": px_doc["MAKHO"], "MAHANG": mahang},
-                                {"$inc": {"SOLUONG": -soluong}},
-                            )
-                            st.success("Đã thêm chi tiết")
-                            st.rerun()
-
-            if details:
-                st.markdown("**Sửa/Xóa chi tiết xuất**")
-                edit_mahang = st.selectbox(
-                    "Chọn chi tiết xuất",
-                    [d["MAHANG"] for d in details],
-                    key="ctpx_edit_select",
+                    if short is None:
+                        st.success("Đã cập nhật")
+                        fetch_stock.clear()
+                        _rerun_fragment()
+                    st.error(f"Tồn kho không đủ (còn {short})")
+
+        if st.button("Xóa chi tiết xuất", key="delete_ctpx"):
+            def delete_line(session: Any) -> None:
+                ctpx_col.delete_one(
+                    {"MAPX": selected_px, "MAHANG": edit_mahang}, session=session
+                )
+                inventory_col.update_one(
+                    {"MAKHO": px_doc["MAKHO"], "MAHANG": edit_mahang},
+                    {"$inc": {"SOLUONG": edit_doc["SOLUONG"]}},
+                    session=session,
                 )
-                edit_doc = next(d for d in details if d["MAHANG"] == edit_mahang)
-                with st.form("ctpx_edit_form"):
-                    new_qty = st.number_input(
-                        "Số lượng", min_value=1, value=edit_doc["SOLUONG"], step=1
-                    )
-                    new_price = st.number_input(
-                        "Đơn giá", min_value=0.0, value=float(edit_doc.get("DONGIA", 0)), step=1000.0
-                    )
-                    submit_edit = st.form_submit_button("Cập nhật")
-                    if submit_edit:
-                        diff = new_qty - edit_doc["SOLUONG"]
-                        inv = inventory_col.find_one({"MAKHO": px_doc["MAKHO"], "MAHANG": edit_mahang})
-                        available = inv.get("SOLUONG", 0) if inv else 0
-                        if diff > 0 and diff > available:
-                            st.error(f"Tồn kho không đủ (còn {available})")
-                        else:
-                            ctpx_col.update_one(
-                                {"MAPX": selected_px, "MAHANG": edit_mahang},
-                                {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-                            )
-                            if diff != 0:
-                                inventory_col.update_one(
-                                    {"MAKHO": px_doc["MAKHO"], "MAHANG": edit_mahang},
-                                    {"$inc": {"SOLUONG": -diff}},
-                                )
-                            st.success("Đã cập nhật")
-                            st.rerun()
-
-                if st.button("Xóa chi tiết xuất", key="delete_ctpx"):
-                    ctpx_col.delete_one({"MAPX": selected_px, "MAHANG": edit_mahang})
-                    inventory_col.update_one(
-                        {"MAKHO": px_doc["MAKHO"], "MAHANG": edit_mahang},
-                        {"$inc": {"SOLUONG": edit_doc["SOLUONG"]}},
-                    )
-                    st.success("Đã xóa chi tiết") 
-                    st.rerun()
 
+            try:
+                dbm.run_transaction(branch, delete_line)
+            except PyMongoError as e:
+                st.error(f"Lỗi khi xóa chi tiết: {e}")
+            else:
+                st.success("Đã xóa chi tiết")
+                fetch_stock.clear()
+                _rerun_fragment()
 
-def show_create_account(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
+
+def show_create_account(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
     """UI for creating new login accounts."""
     st.header("Tạo tài khoản mới")
-    role = user["role"].capitalize()
-    if role not in {"Congty", "Chinhanh"}:
+    if not ctx.can_create_accounts:
         st.warning("Bạn không có quyền tạo tài khoản mới")
         return
     with st.form("create_account_form"):
         username = st.text_input("Tên đăng nhập")
         password = st.text_input("Mật khẩu", type="password")
         # Role selection based on current user
-        if role == "Congty":
+        if ctx.is_congty:
             role_options = ["CongTy", "ChiNhanh", "User"]
         else:
             # ChiNhanh can only create ChiNhanh or User
@@ -988,13 +1305,15 @@ def show_create_account(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
         branch = None
         if selected_role in {"ChiNhanh", "User"}:
             # Branch must be chosen
-            if role == "Congty":
+            if ctx.is_congty:
                 branch = st.selectbox("Chi nhánh", ["CN1", "CN2"])
             else:
-                branch = user.get("branch")
+                branch = ctx.branch
                 st.info(f"Tài khoản sẽ được gán cho chi nhánh {branch}")
         submit = st.form_submit_button("Tạo tài khoản")
-        if submit:
+        if submit and not (username.strip() and password):
+            st.error("Tên đăng nhập và mật khẩu là bắt buộc")
+        elif submit:
             try:
                 auth.create_user(dbm, username, password, selected_role, branch)
                 st.success("Đã tạo tài khoản thành công")
@@ -1002,7 +1321,7 @@ def show_create_account(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
                 st.error(str(e))
 
 
-def show_reports(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
+def show_reports(dbm: DatabaseManager, ctx: auth.UserCtx) -> None:
     """Placeholder for reports accessible to CongTy."""
     st.header("Báo cáo")
     st.info(
@@ -1012,5 +1331,18 @@ def show_reports(dbm: DatabaseManager, user: Dict[str, Any]) -> None:
     )
 
 
+# Page renderers by menu entry
+PAGES = {
+    "Tổng quan": show_dashboard,
+    "Nhân viên": show_employees,
+    "Kho": show_warehouses,
+    "Vật tư": show_materials,
+    "Đơn hàng": show_orders,
+    "Phiếu nhập/xuất": show_receipts,
+    "Tạo tài khoản": show_create_account,
+    "Báo cáo": show_reports,
+}
+
+
 if __name__ == "__main__":
     main()
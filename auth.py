@@ -6,10 +6,11 @@ Each user document contains a username, a hashed password, a role
 (CongTy, ChiNhanh, or User) and an optional branch code. Branch codes are
 only set for users belonging to a particular branch (ChiNhanh or User roles).
 
-Passwords are hashed using SHA‑256 to avoid storing plain text. In a more
-secure implementation you could use the `bcrypt` library or another strong
-password hashing algorithm. This module does not enforce password
-complexity – that is left to the UI layer.
+Passwords are stretched with scrypt using a random per-user salt, and the
+salt is stored next to the hash. Accounts created before the switch still
+carry an unsalted SHA‑256 hex digest and keep verifying until their password
+is reset. This module does not enforce password complexity – that is left to
+the UI layer.
 
 The PyMongo tutorial explains that to get a collection you simply access it
 via the database: `collection = db.test_collection`【282328984375463†L202-L214】. We
@@ -17,65 +18,155 @@ follow the same pattern here.
 """
 
 import hashlib
+import hmac
+import os
+from dataclasses import dataclass
 from typing import Optional, Dict, Any
 
-from database import DatabaseManager
+from database import DatabaseManager, DuplicateKeyError
 
 
-def _hash_password(password: str) -> str:
-    """Return a SHA‑256 hash of the given password.
+SCRYPT_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1, "dklen": 32}
+
+# Hashed for unknown usernames so a failed login costs the same scrypt run
+# whether or not the account exists, and timing does not reveal usernames
+_DUMMY_SALT = os.urandom(16)
+_DUMMY_HASH = bytes(SCRYPT_PARAMS["dklen"])
+
+
+ROLES = ("Congty", "Chinhanh", "User")
+
+
+def _normalize_role(role: Optional[str]) -> Optional[str]:
+    """Return the canonical spelling of a role name ("CongTy" -> "Congty")."""
+    return role.strip().capitalize() if role else None
+
+
+@dataclass(frozen=True, slots=True)
+class UserCtx:
+    """Immutable view of the logged-in user with its permissions precomputed.
+
+    Built once at login from the document returned by :func:`authenticate`,
+    so pages branch on booleans instead of re-deriving them from the role
+    string on every rerun.
+    """
+
+    username: str
+    role: str
+    branch: Optional[str]
+    can_edit: bool
+    can_create_accounts: bool
+    is_congty: bool
+
+    @classmethod
+    def from_user(cls, user: Dict[str, Any]) -> "UserCtx":
+        """Derive the context from an authenticated user document."""
+        role = _normalize_role(user.get("role"))
+        managers = role in {"Congty", "Chinhanh"}
+        return cls(
+            username=user["username"],
+            role=role,
+            branch=user.get("branch"),
+            can_edit=managers,
+            can_create_accounts=managers,
+            is_congty=role == "Congty",
+        )
+
+
+def _hash_password(password: str, salt: bytes) -> bytes:
+    """Return the scrypt hash of the given password.
 
     Args:
         password: Plain text password.
+        salt: Per-user random salt.
 
     Returns:
-        Hexadecimal digest of the password.
+        Raw derived key bytes.
     """
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, **SCRYPT_PARAMS)
 
 
-def create_user(
-    dbm: DatabaseManager,
+def _verify_password(user: Dict[str, Any], password: str) -> bool:
+    """Check ``password`` against the hash stored on a user document.
+
+    Documents without a ``salt`` hold a legacy unsalted SHA‑256 hex digest.
+    Both forms are compared in constant time.
+    """
+    stored = user.get("password_hash")
+    if stored is None:
+        return False
+    salt = user.get("salt")
+    if salt is None:
+        candidate = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(str(stored), candidate)
+    return hmac.compare_digest(bytes(stored), _hash_password(password, bytes(salt)))
+
+
+def build_user(
     username: str,
     password: str,
     role: str,
     branch: Optional[str] = None,
-) -> None:
-    """Create a new user with the specified role and branch.
+) -> Dict[str, Any]:
+    """Validate the arguments and return a ready-to-insert user document.
 
     Args:
-        dbm: Instance of `DatabaseManager` for DB access.
-        username: Desired login name. Must be unique.
+        username: Desired login name.
         password: Plain text password that will be hashed.
         role: One of "CongTy", "ChiNhanh" or "User".
         branch: Branch code (e.g. "CN1" or "CN2"). Required for roles
             "ChiNhanh" and "User". Ignored for "CongTy".
 
     Raises:
-        ValueError: If the username already exists or required arguments are
-            missing.
+        ValueError: If required arguments are missing or invalid.
     """
-    role = role.strip().capitalize() if role else None
-    if role not in {"Congty", "Chinhanh", "User"}:
+    role = _normalize_role(role)
+    if role not in ROLES:
         raise ValueError("Role must be one of CongTy, ChiNhanh or User")
     if role in {"Chinhanh", "User"} and not branch:
         raise ValueError("Branch must be provided for ChiNhanh and User roles")
-    # Normalize username
-    username = username.lower()
-
-    users_col = dbm.get_collection(None, "users")
-    if users_col.find_one({"username": username}):
-        raise ValueError(f"User '{username}' already exists")
 
+    salt = os.urandom(16)
     user_doc: Dict[str, Any] = {
-        "username": username,
-        "password_hash": _hash_password(password),
+        # Normalize username
+        "username": username.lower(),
+        "salt": salt,
+        "password_hash": _hash_password(password, salt),
         "role": role,
     }
     if role in {"Chinhanh", "User"}:
         user_doc["branch"] = branch.upper()
+    return user_doc
 
-    users_col.insert_one(user_doc)
+
+def create_user(
+    dbm: DatabaseManager,
+    username: str,
+    password: str,
+    role: str,
+    branch: Optional[str] = None,
+) -> None:
+    """Create a new user with the specified role and branch.
+
+    Args:
+        dbm: Instance of `DatabaseManager` for DB access.
+        username: Desired login name. Must be unique.
+        password: Plain text password that will be hashed.
+        role: One of "CongTy", "ChiNhanh" or "User".
+        branch: Branch code (e.g. "CN1" or "CN2"). Required for roles
+            "ChiNhanh" and "User". Ignored for "CongTy".
+
+    Raises:
+        ValueError: If the username already exists or required arguments are
+            missing.
+    """
+    user_doc = build_user(username, password, role, branch)
+    users_col = dbm.get_collection(None, "users")
+    # The unique index on users.username rejects duplicates in one round trip
+    try:
+        users_col.insert_one(user_doc)
+    except DuplicateKeyError:
+        raise ValueError(f"User '{user_doc['username']}' already exists") from None
 
 
 def authenticate(dbm: DatabaseManager, username: str, password: str) -> Optional[Dict[str, Any]]:
@@ -88,15 +179,22 @@ def authenticate(dbm: DatabaseManager, username: str, password: str) -> Optional
 
     Returns:
         The user document without the password hash if authentication passes,
-        otherwise `None`.
+        otherwise `None`. The ``role`` field is normalized to one of
+        ``ROLES`` ("Congty", "Chinhanh", "User") so callers can compare it
+        directly.
     """
     if not username or not password:
         return None
     users_col = dbm.get_collection(None, "users")
     user = users_col.find_one({"username": username.lower()})
-    if user and user.get("password_hash") == _hash_password(password):
+    if user is None:
+        hmac.compare_digest(_DUMMY_HASH, _hash_password(password, _DUMMY_SALT))
+        return None
+    if _verify_password(user, password):
         # Remove sensitive fields before returning
         user.pop("password_hash", None)
+        user.pop("salt", None)
+        user["role"] = _normalize_role(user.get("role"))
         return user
     return None
 
@@ -115,4 +213,5 @@ def get_user(dbm: DatabaseManager, username: str) -> Optional[Dict[str, Any]]:
     user = users_col.find_one({"username": username.lower()})
     if user:
         user.pop("password_hash", None)
+        user.pop("salt", None)
     return user
@@ -27,26 +27,161 @@ creates a connection to a local MongoDB instance【282328984375463†L168-L193
 
 """
 
+import logging
 import os
-from typing import Dict, Any, Optional
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, ClassVar, Dict, Iterable, List, NamedTuple, Optional, TypeVar
 
 try:
     # Try to import the official PyMongo driver.  If it’s not available
     # (for example in a constrained environment), we'll fall back to mongomock.
-    from pymongo import MongoClient  # type: ignore
+    from pymongo import DeleteOne, IndexModel, InsertOne, MongoClient, ReturnDocument, UpdateOne  # type: ignore
     from pymongo.collection import Collection  # type: ignore
+    from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError  # type: ignore
     pymongo_available = True
 except ImportError:  # pragma: no cover - fallback when PyMongo is missing
     pymongo_available = False
     MongoClient = None  # type: ignore
+    ReturnDocument = None  # type: ignore
+    # Bulk write operations and index models are only provided by PyMongo
+    DeleteOne = InsertOne = UpdateOne = IndexModel = None  # type: ignore
     Collection = None  # type: ignore
 
 try:
     import mongomock  # type: ignore
     mongomock_available = True
+    if not pymongo_available:  # pragma: no cover - mongomock ships its own errors
+        from mongomock import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError  # type: ignore
+        from mongomock.collection import ReturnDocument  # type: ignore
 except ImportError:  # pragma: no cover - mongomock is optional
     mongomock_available = False
 
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+# Server error code returned when transactions are used on a standalone mongod
+ILLEGAL_OPERATION = 20
+
+# Server error code of a unique index violation
+DUPLICATE_KEY = 11000
+
+# Server error code returned when change streams are opened on a standalone mongod
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+# Connection pool settings shared by every MongoClient. Streamlit serves all
+# sessions from one process, so the pool is bounded and kept warm, idle
+# sockets beyond the minimum are closed after a minute, and requests that
+# cannot get a connection fail fast instead of queueing.
+POOL_OPTIONS = {
+    "maxPoolSize": 50,
+    "minPoolSize": 5,
+    "maxIdleTimeMS": 60000,
+    "waitQueueTimeoutMS": 5000,
+    "retryWrites": True,
+}
+
+# Environment variables that tune the pool sizes per deployment
+POOL_ENV = {
+    "maxPoolSize": "MONGODB_MAX_POOL",
+    "minPoolSize": "MONGODB_MIN_POOL",
+    "maxIdleTimeMS": "MONGODB_MAX_IDLE_MS",
+}
+
+
+def _pool_options_from_env() -> Dict[str, Any]:
+    """Return ``POOL_OPTIONS`` with the overrides set in ``POOL_ENV``.
+
+    A value that is not an integer is ignored with a warning, so a typo in
+    the environment cannot keep the app from starting.
+    """
+    options = dict(POOL_OPTIONS)
+    for option, variable in POOL_ENV.items():
+        raw = os.getenv(variable, "").strip()
+        if not raw:
+            continue
+        try:
+            options[option] = int(raw)
+        except ValueError:
+            warnings.warn(
+                f"Ignoring {variable}={raw!r}: expected an integer, using {options[option]}",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+    return options
+
+
+# Collections stored per branch on server1/server2; the rest live on server3
+TRANSACTIONAL_COLLECTIONS = frozenset(
+    {"DatHang", "CTDDH", "PhieuNhap", "CTPN", "PhieuXuat", "CTPX", "Inventory"}
+)
+REFERENCE_COLLECTIONS = frozenset({"Nhanvien", "Kho", "Vattu", "users"})
+
+# Reference collections small and static enough to keep in memory (get_ref);
+# users is left out so password hashes are never held longer than needed
+CACHED_REFERENCE_COLLECTIONS = frozenset({"Nhanvien", "Kho", "Vattu"})
+
+# Seconds get_ref serves a collection from memory. Writes through this
+# process invalidate it at once; the TTL bounds how long writes made by other
+# processes go unseen where no change stream reports them (standalone servers)
+REF_TTL = 60
+
+# Seconds a change stream watcher waits before reopening a dropped stream,
+# doubled after each failure in a row up to the maximum
+WATCH_RETRY_DELAY = 1
+WATCH_RETRY_MAX_DELAY = 60
+
+# Worker threads for DatabaseManager.gather; a page issues a handful of
+# independent reads at most, far below the connection pool size
+GATHER_WORKERS = 8
+
+
+class BulkOp(NamedTuple):
+    """One write of a :meth:`DatabaseManager.bulk_write` batch.
+
+    Plain data rather than a PyMongo operation object, so the batch can be
+    replayed through the regular collection methods where PyMongo's own
+    operations are not understood (mongomock).
+    """
+
+    kind: str  # "insert", "update" or "delete"
+    filter: Optional[Dict[str, Any]]
+    document: Optional[Dict[str, Any]] = None
+    upsert: bool = False
+
+    @classmethod
+    def insert(cls, document: Dict[str, Any]) -> "BulkOp":
+        return cls("insert", None, document)
+
+    @classmethod
+    def update(cls, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> "BulkOp":
+        return cls("update", filter, update, upsert)
+
+    @classmethod
+    def delete(cls, filter: Dict[str, Any]) -> "BulkOp":
+        return cls("delete", filter)
+
+    def to_pymongo(self) -> Any:
+        """Return the equivalent PyMongo ``InsertOne``/``UpdateOne``/``DeleteOne``."""
+        if self.kind == "insert":
+            return InsertOne(self.document)
+        if self.kind == "update":
+            return UpdateOne(self.filter, self.document, upsert=self.upsert)
+        if self.kind == "delete":
+            return DeleteOne(self.filter)
+        raise TypeError(f"Unsupported bulk operation: {self!r}")
+
+
+class Branch(str, Enum):
+    """Branch codes owning transactional data; members compare equal to their codes."""
+
+    CN1 = "CN1"
+    CN2 = "CN2"
+
 
 class DatabaseManager:
     """Central manager to handle connections to distributed MongoDB servers.
@@ -59,16 +194,31 @@ class DatabaseManager:
     testing.
     """
 
+    # Real clients by URI and pool options, shared by every manager in the
+    # process so servers whose URIs coincide use one connection pool
+    _client_registry: ClassVar[Dict[Any, Any]] = {}
+    _registry_lock: ClassVar[threading.Lock] = threading.Lock()
+
     def __init__(
         self,
         uri_server1: Optional[str] = None,
         uri_server2: Optional[str] = None,
         uri_server3: Optional[str] = None,
+        pool_options: Optional[Dict[str, Any]] = None,
     ) -> None:
         # Determine connection strings: environment variables take precedence
         self.uri_server1 = uri_server1 or os.getenv("MONGODB_URI_SERVER1")
         self.uri_server2 = uri_server2 or os.getenv("MONGODB_URI_SERVER2")
         self.uri_server3 = uri_server3 or os.getenv("MONGODB_URI_SERVER3")
+        # Explicit options override the environment and defaults key by key
+        self.pool_options = {**_pool_options_from_env(), **(pool_options or {})}
+
+        # In-memory client shared by this manager's servers when no URI is set
+        self._mock_client = None
+
+        # ids of clients known to lack transaction support; the manager keeps
+        # its clients alive, so an id is never reused while it is listed here
+        self._sessionless: set = set()
 
         # Initialize clients for each server
         self.client_server1 = self._create_client(self.uri_server1, name="server1")
@@ -80,6 +230,22 @@ class DatabaseManager:
         self.db_server2 = self.client_server2["qlhh_server2"]
         self.db_server3 = self.client_server3["qlhh_server3"]
 
+        # Database holding each branch's transactional collections
+        self._tx_dbs = {Branch.CN1: self.db_server1, Branch.CN2: self.db_server2}
+
+        # Collection handles by (branch, name), filled by get_collection
+        self._collections: Dict[Any, Any] = {}
+
+        # (read at, documents) by collection name, filled by get_ref; the
+        # generation is bumped by every invalidation so a read that raced
+        # with a write never stores what it fetched
+        self._ref_cache: Dict[str, Any] = {}
+        self._ref_generation = 0
+        self._ref_lock = threading.Lock()
+
+        # Shared by every session; threads are only started when first used
+        self._executor = ThreadPoolExecutor(max_workers=GATHER_WORKERS, thread_name_prefix="dbm")
+
     def _create_client(self, uri: Optional[str], name: str):
         """Create a MongoDB client for a server.
 
@@ -91,18 +257,30 @@ class DatabaseManager:
                 password. If `None`, a mongomock client is used.
             name: Human friendly name of the server used for logging.
 
+        Clients are reused: a URI already opened with the same pool options
+        returns the existing MongoClient, and the mongomock fallback is one
+        client per manager (the servers keep apart through their database
+        names, while separate managers keep separate data).
+
         Returns:
             A MongoClient‑like instance.
         """
         if uri and pymongo_available:
             # Use a real MongoDB connection
-            return MongoClient(uri)
+            key = (uri, tuple(sorted(self.pool_options.items())))
+            with self._registry_lock:
+                client = self._client_registry.get(key)
+                if client is None:
+                    client = self._client_registry[key] = MongoClient(uri, **self.pool_options)
+            return client
         # Fallback: use mongomock for in‑memory database
         if not mongomock_available:
             raise RuntimeError(
                 f"Neither PyMongo nor mongomock is available. You must install at least one"
             )
-        return mongomock.MongoClient()
+        if self._mock_client is None:
+            self._mock_client = mongomock.MongoClient()
+        return self._mock_client
 
     def get_collection(self, branch: str, collection_name: str) -> Any:
         """Return the appropriate collection for a given branch.
@@ -112,44 +290,244 @@ class DatabaseManager:
         Shared collections (employee, warehouse, users) live on server3.
 
         Args:
-            branch: Branch code (e.g., "CN1" or "CN2"). When `None`, the
+            branch: Branch code (a :class:`Branch` or a string such as "CN1").
+                Lower-case codes are accepted. When `None`, the
                 collection is assumed to be shared and thus read from server3.
             collection_name: Name of the MongoDB collection.
 
         Returns:
-            The requested collection object.
+            The requested collection object. Handles are long-lived and
+            thread-safe, so each one is resolved once and then reused.
         """
-        branch = branch.upper() if branch else None
-        # Determine which server holds the collection
-        transactional_collections = {
-            "DatHang",
-            "CTDDH",
-            "PhieuNhap",
-            "CTPN",
-            "PhieuXuat",
-            "CTPX",
-            "Inventory",
-        }
-        reference_collections = {
-            "Nhanvien",
-            "Kho",
-            "Vattu",
-            "users",
-        }
-
-        if collection_name in reference_collections:
+        # Branch members and the upper-case codes callers pass hash alike, so
+        # the common case is a single dict lookup
+        collection = self._collections.get((branch, collection_name))
+        if collection is None:
+            normalized = branch.upper() if branch else None
+            collection = self._collections.get((normalized, collection_name))
+            if collection is None:
+                collection = self._resolve_collection(normalized, collection_name)
+                self._collections[(normalized, collection_name)] = collection
+            self._collections[(branch, collection_name)] = collection
+        return collection
+
+    def _resolve_collection(self, branch: Optional[str], collection_name: str) -> Any:
+        """Pick the server holding ``collection_name`` for an upper-cased branch."""
+        if collection_name in REFERENCE_COLLECTIONS:
             # Shared collections live on server3
             return self.db_server3[collection_name]
-        if collection_name in transactional_collections:
-            if branch == "CN1":
-                return self.db_server1[collection_name]
-            elif branch == "CN2":
-                return self.db_server2[collection_name]
-            else:
+        if collection_name in TRANSACTIONAL_COLLECTIONS:
+            db = self._tx_dbs.get(branch)
+            if db is None:
                 raise ValueError(f"Unsupported branch for transactional data: {branch}")
+            return db[collection_name]
         # For undefined collections assume server3
         return self.db_server3[collection_name]
 
+    def get_client(self, branch: str) -> Any:
+        """Return the client of the server holding a branch's transactional data.
+
+        Args:
+            branch: Branch code ("CN1" or "CN2").
+
+        Returns:
+            The MongoClient (or mongomock client) for server1 or server2.
+        """
+        branch = branch.upper() if branch else None
+        if branch == "CN1":
+            return self.client_server1
+        if branch == "CN2":
+            return self.client_server2
+        raise ValueError(f"Unsupported branch for transactional data: {branch}")
+
+    def run_transaction(self, branch: str, callback: Callable[[Any], T]) -> T:
+        """Run ``callback(session)`` inside one transaction on a branch server.
+
+        Every write the callback issues with ``session=session`` is committed
+        together, or not at all if the callback raises. The transaction goes
+        through ``ClientSession.with_transaction``, which retries the callback
+        on ``TransientTransactionError`` and the commit on
+        ``UnknownTransactionCommitResult``, so the callback must be safe to
+        run more than once. Deployments without transaction support
+        (mongomock, or a standalone ``mongod`` as in the bundled docker
+        compose file) run the callback once without a session instead, in
+        which case ``session`` is ``None``; that is detected on the first call
+        and remembered per client.
+
+        Args:
+            branch: Branch code selecting server1 or server2.
+            callback: Function performing the writes; its result is returned.
+
+        Returns:
+            Whatever ``callback`` returns.
+        """
+        client = self.get_client(branch)
+        if id(client) not in self._sessionless:
+            try:
+                with client.start_session() as session:
+                    return session.with_transaction(callback)
+            except NotImplementedError:
+                # mongomock does not implement sessions
+                pass
+            except OperationFailure as exc:
+                # Standalone servers reject the first operation of a transaction
+                if exc.code != ILLEGAL_OPERATION:
+                    raise
+            self._sessionless.add(id(client))
+        return callback(None)
+
+    def bulk_write(
+        self, collection: Any, requests: List[BulkOp], session: Any = None, ordered: bool = False
+    ) -> None:
+        """Send a batch of write operations to one collection in a single call.
+
+        By default the batch is unordered so the server may apply the
+        operations in any order and does not stop at the first failure; an
+        ordered batch is applied in sequence and stops at the first failing
+        operation. mongomock cannot consume the operation objects of recent
+        PyMongo releases, so against an in‑memory collection each operation
+        is applied individually instead, with duplicate keys reported the
+        same way the server reports them.
+
+        Args:
+            collection: Target collection.
+            requests: Operations built with ``BulkOp.insert``, ``BulkOp.update``
+                and ``BulkOp.delete``.
+            session: Optional session from :meth:`run_transaction`.
+            ordered: Apply the operations in sequence and stop at the first
+                failure.
+
+        Raises:
+            BulkWriteError: Some operations failed; ``details["writeErrors"]``
+                holds the ``index`` and ``code`` of each failure.
+        """
+        if not requests:
+            return
+        if mongomock_available and isinstance(collection, mongomock.Collection):
+            errors = []
+            for index, op in enumerate(requests):
+                try:
+                    if op.kind == "insert":
+                        collection.insert_one(op.document)
+                    elif op.kind == "update":
+                        collection.update_one(op.filter, op.document, upsert=op.upsert)
+                    elif op.kind == "delete":
+                        collection.delete_one(op.filter)
+                    else:
+                        raise TypeError(f"Unsupported bulk operation: {op!r}")
+                except DuplicateKeyError as exc:
+                    errors.append({"index": index, "code": DUPLICATE_KEY, "errmsg": str(exc)})
+                    if ordered:
+                        break
+            if errors:
+                raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": []})
+            return
+        collection.bulk_write([op.to_pymongo() for op in requests], ordered=ordered, session=session)
+
+    def gather(self, calls: Dict[str, Callable[[], T]]) -> Dict[str, T]:
+        """Run independent reads concurrently and return their results by name.
+
+        MongoClient is thread-safe, so reads against different servers (or
+        several against one) overlap their round trips and the caller waits
+        for the slowest one instead of their sum. An exception raised by any
+        call is re-raised here.
+
+        Args:
+            calls: Zero-argument callables keyed by the name of their result.
+
+        Returns:
+            The results under the same keys.
+        """
+        futures = {name: self._executor.submit(call) for name, call in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def get_ref(self, collection_name: str) -> List[Dict[str, Any]]:
+        """Return all documents of a reference collection, cached for ``REF_TTL``.
+
+        Calls within ``REF_TTL`` seconds of the read are answered from memory
+        unless :meth:`invalidate_ref` was called for the collection, which
+        every writer of reference data in this process must do. The returned
+        list is shared and must not be modified.
+
+        Args:
+            collection_name: One of ``CACHED_REFERENCE_COLLECTIONS``.
+
+        Returns:
+            The documents without their ``_id``.
+        """
+        now = time.monotonic()
+        hit = self._ref_cache.get(collection_name)
+        if hit is not None and now - hit[0] < REF_TTL:
+            return hit[1]
+        if collection_name not in CACHED_REFERENCE_COLLECTIONS:
+            raise ValueError(f"Not a cached reference collection: {collection_name}")
+        generation = self._ref_generation
+        docs = list(self.db_server3[collection_name].find({}, {"_id": 0}))
+        with self._ref_lock:
+            if generation == self._ref_generation:
+                self._ref_cache[collection_name] = (now, docs)
+        return docs
+
+    def invalidate_ref(self, collection_name: Optional[str] = None) -> None:
+        """Forget the cached documents of one reference collection, or of all."""
+        with self._ref_lock:
+            self._ref_generation += 1
+            if collection_name is None:
+                self._ref_cache.clear()
+            else:
+                self._ref_cache.pop(collection_name, None)
+
+    def watch_changes(
+        self, db: Any, collections: Iterable[str], on_change: Callable[[str], None]
+    ) -> Optional[threading.Thread]:
+        """Report writes to some collections of a server from a background thread.
+
+        A daemon thread follows a change stream on ``db`` and calls
+        ``on_change(collection_name)`` for every change to one of
+        ``collections``; an exception from ``on_change`` is logged and the
+        stream goes on. A stream that ends or fails is reopened after a delay
+        that doubles from ``WATCH_RETRY_DELAY`` up to
+        ``WATCH_RETRY_MAX_DELAY``. Change streams need a replica set:
+        mongomock and standalone servers (such as the bundled docker compose
+        setup) cannot provide them, in which case nothing is watched.
+
+        Args:
+            db: Database of server1, server2 or server3.
+            collections: Names of the collections to watch.
+            on_change: Callback receiving the name of the changed collection.
+
+        Returns:
+            The watcher thread, or ``None`` for an in‑memory database.
+        """
+        if mongomock_available and isinstance(db, mongomock.Database):
+            return None
+        pipeline = [{"$match": {"ns.coll": {"$in": list(collections)}}}]
+
+        def follow() -> None:
+            delay = WATCH_RETRY_DELAY
+            while True:
+                try:
+                    with db.watch(pipeline) as stream:
+                        delay = WATCH_RETRY_DELAY
+                        for change in stream:
+                            name = change["ns"]["coll"]
+                            try:
+                                on_change(name)
+                            except Exception:
+                                logger.exception("Handling a change to %s.%s failed", db.name, name)
+                    logger.warning("Change stream on %s ended; reopening in %s s", db.name, delay)
+                except PyMongoError as exc:
+                    if isinstance(exc, OperationFailure) and exc.code == CHANGE_STREAM_NOT_SUPPORTED:
+                        logger.info("Change streams are not supported by %s; not watching it", db.name)
+                        return
+                    logger.warning("Change stream on %s failed (%s); reopening in %s s", db.name, exc, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, WATCH_RETRY_MAX_DELAY)
+
+        thread = threading.Thread(target=follow, name=f"watch-{db.name}", daemon=True)
+        thread.start()
+        return thread
+
     def init_schema(self) -> None:
         """Ensure indexes and basic fields exist for all collections.
 
@@ -169,33 +547,63 @@ class DatabaseManager:
           * `users.username`
 
         The unique indexes ensure there are no duplicate primary keys within a
-        collection.
+        collection. `Nhanvien` and `Kho` also get compound `(MACN, MANV)` and
+        `(MACN, MAKHO)` indexes: every branch-scoped page filters on `MACN`
+        and reads the code, so these serve both the filter and the code lists.
+        """
+        # Reference collections on server3, as (keys, options) per index
+        reference_indexes = {
+            "Nhanvien": [("MANV", {"unique": True}), ([("MACN", 1), ("MANV", 1)], {})],
+            "Kho": [("MAKHO", {"unique": True}), ([("MACN", 1), ("MAKHO", 1)], {})],
+            "Vattu": [("MAHANG", {"unique": True})],
+            "users": [("username", {"unique": True})],
+        }
+        for col_name, specs in reference_indexes.items():
+            self._ensure_indexes(self.db_server3[col_name], specs)
+
+        # Primary documents have single-field unique indexes, detail lines
+        # compound ones to avoid duplicates
+        branch_indexes = {
+            "DatHang": [("MasoDDH", {"unique": True, "sparse": True})],
+            "PhieuNhap": [("MAPN", {"unique": True, "sparse": True})],
+            "PhieuXuat": [("MAPX", {"unique": True, "sparse": True})],
+            "CTDDH": [([("MasoDDH", 1), ("MAHANG", 1)], {"unique": True})],
+            "CTPN": [([("MAPN", 1), ("MAHANG", 1)], {"unique": True})],
+            "CTPX": [([("MAPX", 1), ("MAHANG", 1)], {"unique": True})],
+            "Inventory": [([("MAKHO", 1), ("MAHANG", 1)], {"unique": True})],
+        }
+        for db in (self.db_server1, self.db_server2):
+            for col_name, specs in branch_indexes.items():
+                self._ensure_indexes(db[col_name], specs)
+
+    def _ensure_indexes(self, collection: Any, specs: List[Any]) -> None:
+        """Create every index of one collection in a single command.
+
+        ``specs`` holds ``(keys, options)`` pairs as accepted by
+        ``create_index``. Without PyMongo's ``IndexModel`` (mongomock on its
+        own) the indexes are created one at a time instead.
         """
-        # Ensure indexes on reference collections
-        self.db_server3["Nhanvien"].create_index("MANV", unique=True)
-        self.db_server3["Kho"].create_index("MAKHO", unique=True)
-        self.db_server3["Vattu"].create_index("MAHANG", unique=True)
-        self.db_server3["users"].create_index("username", unique=True)
-
-        
-        # Primary documents have single-field unique indexes
-        for col_name, key in [
-            ("DatHang", "MasoDDH"),
-            ("PhieuNhap", "MAPN"),
-            ("PhieuXuat", "MAPX"),
-        ]:
-            self.db_server1[col_name].create_index(key, unique=True, sparse=True)
-            self.db_server2[col_name].create_index(key, unique=True, sparse=True)
-
-        # Detail lines use compound indexes to avoid duplicates
-        for col_name, keys in [
-            ("CTDDH", [("MasoDDH", 1), ("MAHANG", 1)]),
-            ("CTPN", [("MAPN", 1), ("MAHANG", 1)]),
-            ("CTPX", [("MAPX", 1), ("MAHANG", 1)]),
-            ("Inventory", [("MAKHO", 1), ("MAHANG", 1)]),
-        ]:
-            self.db_server1[col_name].create_index(keys, unique=True)
-            self.db_server2[col_name].create_index(keys, unique=True)
+        if IndexModel is None:
+            for keys, options in specs:
+                collection.create_index(keys, **options)
+            return
+        collection.create_indexes([IndexModel(keys, **options) for keys, options in specs])
+
+    def _seed_empty(self, collection: Any, documents: List[Dict[str, Any]]) -> None:
+        """Insert ``documents`` in one unordered batch if ``collection`` is empty.
+
+        A collection with any document is left alone, so records users
+        deleted are not brought back. Duplicate key errors can only come from
+        another process seeding the same empty collection at the same time
+        and are ignored; any other write error is re-raised.
+        """
+        if collection.find_one({}, {"_id": 1}) is not None:
+            return
+        try:
+            collection.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            if any(err.get("code") != DUPLICATE_KEY for err in exc.details.get("writeErrors", [])):
+                raise
 
     def seed_demo_data(self) -> None:
         """Populate the database with a small set of sample records.
@@ -204,70 +612,70 @@ class DatabaseManager:
         materials to allow the Streamlit application to run without requiring
         manual data entry. In production this method should not be called or
         should be adapted to your own dataset.
+
+        Each collection is only seeded while it is still empty, so running it
+        on every start neither duplicates records nor restores the ones users
+        deleted (or the stock they moved).
         """
         # Sample employees – all stored on server3
         nhanvien = self.db_server3["Nhanvien"]
-        if nhanvien.count_documents({}) == 0:
-            nhanvien.insert_many([
-                {
-                    "MANV": "NV01",
-                    "HO": "Nguyen",
-                    "TEN": "Van A",
-                    "DIACHI": "Hanoi",
-                    "NGAYSINH": "1990-01-01",
-                    "LUONG": 1000,
-                    "MACN": "CN1",
-                },
-                {
-                    "MANV": "NV02",
-                    "HO": "Le",
-                    "TEN": "Thi B",
-                    "DIACHI": "Saigon",
-                    "NGAYSINH": "1992-05-15",
-                    "LUONG": 1200,
-                    "MACN": "CN2",
-                },
-            ])
+        self._seed_empty(nhanvien, [
+            {
+                "MANV": "NV01",
+                "HO": "Nguyen",
+                "TEN": "Van A",
+                "DIACHI": "Hanoi",
+                "NGAYSINH": "1990-01-01",
+                "LUONG": 1000,
+                "MACN": "CN1",
+            },
+            {
+                "MANV": "NV02",
+                "HO": "Le",
+                "TEN": "Thi B",
+                "DIACHI": "Saigon",
+                "NGAYSINH": "1992-05-15",
+                "LUONG": 1200,
+                "MACN": "CN2",
+            },
+        ])
 
         # Sample warehouses
         kho = self.db_server3["Kho"]
-        if kho.count_documents({}) == 0:
-            kho.insert_many([
-                {
-                    "MAKHO": "KHO1",
-                    "TENKHO": "Kho CN1",
-                    "DIACHI": "Hanoi",
-                    "MACN": "CN1",
-                },
-                {
-                    "MAKHO": "KHO2",
-                    "TENKHO": "Kho CN2",
-                    "DIACHI": "Saigon",
-                    "MACN": "CN2",
-                },
-            ])
+        self._seed_empty(kho, [
+            {
+                "MAKHO": "KHO1",
+                "TENKHO": "Kho CN1",
+                "DIACHI": "Hanoi",
+                "MACN": "CN1",
+            },
+            {
+                "MAKHO": "KHO2",
+                "TENKHO": "Kho CN2",
+                "DIACHI": "Saigon",
+                "MACN": "CN2",
+            },
+        ])
 
         # Sample materials
         vattu = self.db_server3["Vattu"]
-        if vattu.count_documents({}) == 0:
-            vattu.insert_many([
-                {"MAHANG": "VT01", "TENHANG": "iPhone 15", "DVT": " chiếc"},
-                {"MAHANG": "VT02", "TENHANG": "Samsung S23", "DVT": " chiếc"},
-                {"MAHANG": "VT03", "TENHANG": "Oppo Reno10", "DVT": " chiếc"},
-            ])
+        self._seed_empty(vattu, [
+            {"MAHANG": "VT01", "TENHANG": "iPhone 15", "DVT": " chiếc"},
+            {"MAHANG": "VT02", "TENHANG": "Samsung S23", "DVT": " chiếc"},
+            {"MAHANG": "VT03", "TENHANG": "Oppo Reno10", "DVT": " chiếc"},
+        ])
 
         # Initial inventory for each branch warehouse
         inv1 = self.db_server1["Inventory"]
         inv2 = self.db_server2["Inventory"]
-        if inv1.count_documents({}) == 0:
-            inv1.insert_many([
-                {"MAKHO": "KHO1", "MAHANG": "VT01", "SOLUONG": 100},
-                {"MAKHO": "KHO1", "MAHANG": "VT02", "SOLUONG": 100},
-                {"MAKHO": "KHO1", "MAHANG": "VT03", "SOLUONG": 100},
-            ])
-        if inv2.count_documents({}) == 0:
-            inv2.insert_many([
-                {"MAKHO": "KHO2", "MAHANG": "VT01", "SOLUONG": 100},
-                {"MAKHO": "KHO2", "MAHANG": "VT02", "SOLUONG": 100},
-                {"MAKHO": "KHO2", "MAHANG": "VT03", "SOLUONG": 100},
-            ])
+        self._seed_empty(inv1, [
+            {"MAKHO": "KHO1", "MAHANG": "VT01", "SOLUONG": 100},
+            {"MAKHO": "KHO1", "MAHANG": "VT02", "SOLUONG": 100},
+            {"MAKHO": "KHO1", "MAHANG": "VT03", "SOLUONG": 100},
+        ])
+        self._seed_empty(inv2, [
+            {"MAKHO": "KHO2", "MAHANG": "VT01", "SOLUONG": 100},
+            {"MAKHO": "KHO2", "MAHANG": "VT02", "SOLUONG": 100},
+            {"MAKHO": "KHO2", "MAHANG": "VT03", "SOLUONG": 100},
+        ])
+        self.invalidate_ref()
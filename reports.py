@@ -1,35 +1,91 @@
+import threading
+import time
+import weakref
+from functools import wraps
+
 import pandas as pd
 from database import DatabaseManager
 
+# Seconds a computed report is served from memory before it is recomputed
+REPORT_TTL = 30
+
+# DatabaseManager -> {report name: (computed at, DataFrame)}; entries go away
+# with their manager, so a later manager never gets an earlier one's reports
+_cache: "weakref.WeakKeyDictionary[DatabaseManager, dict]" = weakref.WeakKeyDictionary()
+_cache_lock = threading.Lock()
+# Bumped by every invalidate(); a report computed across a bump is not stored
+_generation = 0
+
+
+def _cached(func):
+    """Keep the report of each DatabaseManager for ``REPORT_TTL`` seconds.
+
+    Callers get a copy, so modifying a returned DataFrame never alters the
+    cached one.
+    """
+
+    @wraps(func)
+    def wrapper(dbm: DatabaseManager) -> pd.DataFrame:
+        now = time.monotonic()
+        with _cache_lock:
+            hit = _cache.get(dbm, {}).get(func.__name__)
+            generation = _generation
+        if hit is None or now - hit[0] >= REPORT_TTL:
+            hit = (now, func(dbm))
+            with _cache_lock:
+                if generation == _generation:
+                    _cache.setdefault(dbm, {})[func.__name__] = hit
+        return hit[1].copy()
+
+    return wrapper
+
+
+def invalidate() -> None:
+    """Drop all cached reports; the app calls it after PhieuNhap or PhieuXuat writes."""
+    global _generation
+    with _cache_lock:
+        _generation += 1
+        _cache.clear()
+
 
 def _get_branches(dbm: DatabaseManager) -> list:
     """Return a list of branch codes present in the system."""
     kho_col = dbm.get_collection(None, "Kho")
-    df = pd.DataFrame(list(kho_col.find()))
-    if df.empty:
-        return []
-    return df["MACN"].dropna().unique().tolist()
+    # Only the distinct branch codes come back from the server
+    return sorted(b for b in kho_col.distinct("MACN") if b)
+
+
+def _count_by_branch(dbm: DatabaseManager, branches: list, collection_names: tuple) -> dict:
+    """Count documents of each collection on every branch server concurrently.
+
+    Each branch maps to its own server and the whole collection is counted, so
+    the collection metadata answers without scanning or transferring any
+    document. Results are keyed by ``(branch, collection_name)``.
+    """
+    calls = {
+        (branch, name): dbm.get_collection(branch, name).estimated_document_count
+        for branch in branches
+        for name in collection_names
+    }
+    return dbm.gather(calls)
 
 
+@_cached
 def revenue_by_branch(dbm: DatabaseManager) -> pd.DataFrame:
     """Aggregate revenue (as count of export receipts) per branch."""
     branches = _get_branches(dbm)
-    records = []
-    for branch in branches:
-        px_col = dbm.get_collection(branch, "PhieuXuat")
-        px_df = pd.DataFrame(list(px_col.find()))
-        revenue = len(px_df)
-        records.append({"branch": branch, "revenue": revenue})
+    counts = _count_by_branch(dbm, branches, ("PhieuXuat",))
+    records = [{"branch": branch, "revenue": counts[(branch, "PhieuXuat")]} for branch in branches]
     return pd.DataFrame(records)
 
 
+@_cached
 def inventory_by_branch(dbm: DatabaseManager) -> pd.DataFrame:
     """Compute a simple inventory metric based on imports minus exports."""
     branches = _get_branches(dbm)
-    records = []
-    for branch in branches:
-        pn_df = pd.DataFrame(list(dbm.get_collection(branch, "PhieuNhap").find()))
-        px_df = pd.DataFrame(list(dbm.get_collection(branch, "PhieuXuat").find()))
-        inventory = len(pn_df) - len(px_df)
-        records.append({"branch": branch, "inventory": inventory})
+    counts = _count_by_branch(dbm, branches, ("PhieuNhap", "PhieuXuat"))
+    records = [
+        {"branch": branch, "inventory": counts[(branch, "PhieuNhap")] - counts[(branch, "PhieuXuat")]}
+        for branch in branches
+    ]
     return pd.DataFrame(records)
@@ -0,0 +1,193 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+from database import DatabaseManager, DuplicateKeyError
+import app
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.init_schema()
+    dbm.seed_demo_data()
+    return dbm
+
+
+def _stock(dbm, mahang, makho="KHO1"):
+    inv = dbm.get_collection("CN1", "Inventory").find_one({"MAKHO": makho, "MAHANG": mahang})
+    return inv["SOLUONG"] if inv else None
+
+
+def _lines(dbm, name, key):
+    return sorted(
+        dbm.get_collection("CN1", name).find(key, {"_id": 0, "MAHANG": 1, "SOLUONG": 1, "DONGIA": 1}),
+        key=lambda d: d["MAHANG"],
+    )
+
+
+def _line(mahang, qty, price=0.0):
+    return {"MAHANG": mahang, "SOLUONG": qty, "DONGIA": price}
+
+
+def _save(dbm, before, after, name="CTPX", key=None, sign=-1):
+    app._save_detail_edits(dbm, "CN1", name, key or {"MAPX": "PX1"}, "KHO1", before, after, sign)
+
+
+def test_save_detail_edits_takes_and_returns_stock(dbm):
+    _save(dbm, [], [_line("VT01", 10), _line("VT02", 5)])
+    assert _stock(dbm, "VT01") == 90
+    assert _stock(dbm, "VT02") == 95
+
+    before = _lines(dbm, "CTPX", {"MAPX": "PX1"})
+    _save(dbm, before, [_line("VT01", 4, 1000.0)])
+    assert _lines(dbm, "CTPX", {"MAPX": "PX1"}) == [_line("VT01", 4, 1000.0)]
+    assert _stock(dbm, "VT01") == 96
+    assert _stock(dbm, "VT02") == 100
+
+
+def test_save_detail_edits_rejects_shortage_without_writing(dbm):
+    with pytest.raises(ValueError, match="VT02"):
+        _save(dbm, [], [_line("VT01", 10), _line("VT02", 101)])
+    # The stock already taken for VT01 is given back
+    assert _stock(dbm, "VT01") == 100
+    assert _stock(dbm, "VT02") == 100
+    assert _lines(dbm, "CTPX", {"MAPX": "PX1"}) == []
+
+
+def test_save_detail_edits_guard_uses_current_stock(dbm):
+    # Another editor took stock after this one loaded the page
+    dbm.get_collection("CN1", "Inventory").update_one(
+        {"MAKHO": "KHO1", "MAHANG": "VT01"}, {"$set": {"SOLUONG": 3}}
+    )
+    with pytest.raises(ValueError, match=r"còn 3"):
+        _save(dbm, [], [_line("VT01", 5)])
+    assert _stock(dbm, "VT01") == 3
+
+
+def test_save_detail_edits_receipt_adds_stock(dbm):
+    key = {"MAPN": "PN1"}
+    _save(dbm, [], [_line("VT01", 7), _line("VT09", 2)], name="CTPN", key=key, sign=1)
+    assert _stock(dbm, "VT01") == 107
+    # A material without an Inventory row gets one
+    assert _stock(dbm, "VT09") == 2
+    # Removing a received line takes the stock out again
+    _save(dbm, _lines(dbm, "CTPN", key), [_line("VT09", 2)], name="CTPN", key=key, sign=1)
+    assert _stock(dbm, "VT01") == 100
+
+
+def test_save_detail_edits_rejects_repeated_material(dbm):
+    with pytest.raises(ValueError, match="trùng"):
+        _save(dbm, [], [_line("VT01", 1), _line("VT01", 2)])
+    assert _stock(dbm, "VT01") == 100
+
+
+def test_materials_are_read_through_the_reference_cache(dbm, monkeypatch):
+    monkeypatch.setattr(app, "get_dbm", lambda: dbm)
+    rows = app.fetch_materials()
+    assert [vt["MAHANG"] for vt in rows] == ["VT01", "VT02", "VT03"]
+    rows[0]["TENHANG"] = "changed"
+    assert app.fetch_materials()[0]["TENHANG"] == "iPhone 15"
+    dbm.get_collection(None, "Vattu").insert_one({"MAHANG": "VT00"})
+    assert app.material_codes() == ["VT01", "VT02", "VT03"]
+    dbm.invalidate_ref("Vattu")
+    assert app.material_codes() == ["VT00", "VT01", "VT02", "VT03"]
+
+
+def test_save_detail_edits_reports_a_line_saved_concurrently(dbm):
+    # Another editor added VT02 to the same issue after this page loaded
+    dbm.get_collection("CN1", "CTPX").insert_one(_line("VT02", 1) | {"MAPX": "PX1"})
+    with pytest.raises(DuplicateKeyError, match="VT02"):
+        _save(dbm, [], [_line("VT01", 10), _line("VT02", 5), _line("VT03", 2)])
+    # Nothing of this save is left behind
+    assert _lines(dbm, "CTPX", {"MAPX": "PX1"}) == [_line("VT02", 1)]
+    assert [_stock(dbm, m) for m in ("VT01", "VT02", "VT03")] == [100, 100, 100]
+
+
+@pytest.fixture
+def known_materials(monkeypatch):
+    monkeypatch.setattr(app, "material_codes", lambda: ["VT01", "VT02", "VT03"])
+
+
+def test_parse_pasted_lines(known_materials):
+    assert app._parse_pasted_lines("vt01, 2, 1500\n\nVT02,3\nVT03,1,") == [
+        _line("VT01", 2, 1500.0),
+        _line("VT02", 3),
+        _line("VT03", 1),
+    ]
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ("", "Chưa nhập"),
+        ("VT01,1,2,3", "Dòng 1: .*4 giá trị"),
+        ("VT01,2\nVT02", "Dòng 2: .*1 giá trị"),
+        ("VT01,2.5", "số nguyên"),
+        ("VT01,0", "số nguyên"),
+        ("VT01,abc", "số nguyên"),
+        ("VT01,2,abc", "đơn giá"),
+        ("VT01,2,-500", "đơn giá"),
+        ("VT01,2,nan", "đơn giá"),
+        ("VT01,2,inf", "đơn giá"),
+        ("VT09,2", "VT09 không tồn tại"),
+    ],
+)
+def test_parse_pasted_lines_rejects_bad_rows(known_materials, text, message):
+    with pytest.raises(ValueError, match=message):
+        app._parse_pasted_lines(text)
+
+
+class Cleared:
+    def __init__(self):
+        self.count = 0
+
+    def clear(self):
+        self.count += 1
+
+
+def test_change_streams_clear_the_dependent_caches(dbm, monkeypatch):
+    watched = {}
+    monkeypatch.setattr(app, "get_dbm", lambda: dbm)
+    monkeypatch.setattr(dbm, "watch_changes", lambda db, names, cb: watched.update(dict.fromkeys(names, cb)))
+    cached = ["fetch_orders", "fetch_receipts", "fetch_issues", "fetch_stock", "fetch_employees",
+              "fetch_warehouses", "order_codes", "receipt_codes", "issue_codes", "employee_codes",
+              "warehouse_codes", "dashboard_counts"]
+    fakes = {name: Cleared() for name in cached}
+    for name, fake in fakes.items():
+        monkeypatch.setattr(app, name, fake)
+    reports_cleared = Cleared()
+    monkeypatch.setattr(app.reports, "invalidate", reports_cleared.clear)
+    app.start_cache_invalidation.clear()
+    app.start_cache_invalidation()
+    app.start_cache_invalidation.clear()
+
+    assert set(watched) == {"DatHang", "PhieuNhap", "PhieuXuat", "Inventory", "Nhanvien", "Kho", "Vattu"}
+    watched["PhieuXuat"]("PhieuXuat")
+    assert {n for n, f in fakes.items() if f.count} == {"fetch_issues", "issue_codes", "dashboard_counts"}
+    assert reports_cleared.count == 1
+
+    dbm.get_ref("Vattu")
+    dbm.get_collection(None, "Vattu").insert_one({"MAHANG": "VT00"})
+    watched["Vattu"]("Vattu")
+    assert "VT00" in [vt["MAHANG"] for vt in dbm.get_ref("Vattu")]
+    for name in watched:
+        watched[name](name)
+    assert all(f.count for f in fakes.values())
+
+
+@pytest.mark.parametrize(
+    "branch, role, expected",
+    [
+        ("CN1", "Chinhanh", {"Nhanvien": 1, "Kho": 1, "PhieuXuat": 2}),
+        (None, "User", {"Nhanvien": 0, "Kho": 0, "PhieuXuat": 1}),
+        (None, "Congty", {"Nhanvien": 2, "Kho": 2, "PhieuXuat": 3}),
+    ],
+)
+def test_dashboard_counts(dbm, monkeypatch, branch, role, expected):
+    monkeypatch.setattr(app, "get_dbm", lambda: dbm)
+    dbm.get_collection("CN1", "PhieuXuat").insert_many([{"MAPX": "PX1"}, {"MAPX": "PX2"}])
+    dbm.get_collection("CN2", "PhieuXuat").insert_one({"MAPX": "PX3"})
+    app.dashboard_counts.clear()
+    counts = app.dashboard_counts(branch, role)
+    app.dashboard_counts.clear()
+    assert counts == {**expected, "Vattu": 3, "DatHang": 0, "PhieuNhap": 0}
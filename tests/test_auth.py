@@ -0,0 +1,73 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import hashlib
+import pytest
+import auth
+from database import DatabaseManager
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.init_schema()
+    return dbm
+
+
+def test_scrypt_round_trip():
+    doc = auth.build_user("Alice", "s3cret", "User", "cn1")
+    assert doc["username"] == "alice"
+    assert doc["branch"] == "CN1"
+    assert len(doc["salt"]) == 16
+    assert doc["password_hash"] == auth._hash_password("s3cret", doc["salt"])
+    assert auth._verify_password(doc, "s3cret")
+    assert not auth._verify_password(doc, "S3cret")
+
+
+def test_salt_differs_per_user():
+    first = auth.build_user("a", "same", "CongTy")
+    second = auth.build_user("b", "same", "CongTy")
+    assert first["salt"] != second["salt"]
+    assert first["password_hash"] != second["password_hash"]
+
+
+def test_legacy_unsalted_user_still_logs_in(dbm):
+    dbm.get_collection(None, "users").insert_one({
+        "username": "old",
+        "password_hash": hashlib.sha256(b"legacy").hexdigest(),
+        "role": "ChiNhanh",
+        "branch": "CN2",
+    })
+    user = auth.authenticate(dbm, "OLD", "legacy")
+    assert user["username"] == "old"
+    assert user["role"] == "Chinhanh"
+    assert auth.authenticate(dbm, "old", "wrong") is None
+
+
+def test_wrong_password_is_rejected(dbm):
+    auth.create_user(dbm, "bob", "right", "User", "CN1")
+    assert auth.authenticate(dbm, "bob", "wrong") is None
+    assert auth.authenticate(dbm, "bob", "") is None
+    assert auth.authenticate(dbm, "nobody", "right") is None
+
+
+def test_secrets_are_never_returned(dbm):
+    auth.create_user(dbm, "carol", "pw", "CongTy")
+    for user in (auth.authenticate(dbm, "carol", "pw"), auth.get_user(dbm, "Carol")):
+        assert user["username"] == "carol"
+        assert "salt" not in user
+        assert "password_hash" not in user
+
+
+def test_create_user_rejects_duplicate_username(dbm):
+    auth.create_user(dbm, "dave", "pw", "User", "CN1")
+    with pytest.raises(ValueError, match="already exists"):
+        auth.create_user(dbm, "DAVE", "other", "User", "CN2")
+    assert dbm.get_collection(None, "users").count_documents({"username": "dave"}) == 1
+
+
+def test_unknown_user_still_pays_for_a_hash(dbm, monkeypatch):
+    hashed = []
+    real_hash = auth._hash_password
+    monkeypatch.setattr(auth, "_hash_password", lambda pw, salt: hashed.append(pw) or real_hash(pw, salt))
+    assert auth.authenticate(dbm, "ghost", "guess") is None
+    assert hashed == ["guess"]
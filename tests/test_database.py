@@ -0,0 +1,343 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import threading
+import pytest
+import database
+from database import POOL_OPTIONS, Branch, BulkOp, DatabaseManager
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, OperationFailure
+
+
+@pytest.fixture
+def dbm():
+    return DatabaseManager()
+
+
+class RecordingCollection:
+    """Stands in for a PyMongo collection and keeps what bulk_write received."""
+
+    def __init__(self):
+        self.calls = []
+
+    def bulk_write(self, requests, ordered=True, session=None):
+        self.calls.append((requests, ordered, session))
+
+
+BATCH = [
+    BulkOp.insert({"K": 1, "V": "a"}),
+    BulkOp.update({"K": 2}, {"$set": {"V": "b"}}, upsert=True),
+    BulkOp.update({"K": 3}, {"$inc": {"N": 1}}),
+    BulkOp.delete({"K": 4}),
+]
+
+
+def test_bulk_write_native_sends_one_unordered_batch(dbm):
+    col = RecordingCollection()
+    dbm.bulk_write(col, BATCH, session="s")
+    assert len(col.calls) == 1
+    requests, ordered, session = col.calls[0]
+    assert requests == [
+        InsertOne({"K": 1, "V": "a"}),
+        UpdateOne({"K": 2}, {"$set": {"V": "b"}}, upsert=True),
+        UpdateOne({"K": 3}, {"$inc": {"N": 1}}, upsert=False),
+        DeleteOne({"K": 4}),
+    ]
+    assert ordered is False
+    assert session == "s"
+
+
+def test_bulk_write_fallback_replays_each_operation(dbm):
+    col = dbm.db_server1["bulk"]
+    col.insert_many([{"K": 3, "N": 1}, {"K": 4}])
+    dbm.bulk_write(col, BATCH)
+    docs = {d["K"]: d for d in col.find({}, {"_id": 0})}
+    assert docs == {1: {"K": 1, "V": "a"}, 2: {"K": 2, "V": "b"}, 3: {"K": 3, "N": 2}}
+
+
+def test_bulk_write_native_passes_ordered(dbm):
+    col = RecordingCollection()
+    dbm.bulk_write(col, BATCH, ordered=True)
+    assert col.calls[0][1] is True
+
+
+@pytest.mark.parametrize("ordered, applied", [(False, [1, 3, 4]), (True, [1])])
+def test_bulk_write_fallback_reports_duplicates(dbm, ordered, applied):
+    col = dbm.db_server1["bulk"]
+    col.create_index("K", unique=True)
+    col.insert_one({"K": 2})
+    batch = [BulkOp.insert({"K": k}) for k in (1, 2, 3, 2, 4)]
+    with pytest.raises(BulkWriteError) as info:
+        dbm.bulk_write(col, batch, ordered=ordered)
+    errors = info.value.details["writeErrors"]
+    assert [e["index"] for e in errors] == ([1] if ordered else [1, 3])
+    assert {e["code"] for e in errors} == {database.DUPLICATE_KEY}
+    assert sorted(col.distinct("K")) == sorted(applied + [2])
+
+
+def test_bulk_write_empty_batch_is_a_no_op(dbm):
+    col = RecordingCollection()
+    dbm.bulk_write(col, [])
+    assert col.calls == []
+
+
+def test_bulk_write_rejects_unknown_kind(dbm):
+    with pytest.raises(TypeError):
+        dbm.bulk_write(dbm.db_server1["bulk"], [BulkOp("replace", {"K": 1})])
+
+
+class StandaloneClient:
+    """Client of a standalone mongod: transactions fail with IllegalOperation."""
+
+    def __init__(self):
+        self.sessions = 0
+
+    def start_session(self):
+        self.sessions += 1
+        return StandaloneSession()
+
+
+class StandaloneSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def with_transaction(self, callback):
+        raise OperationFailure("Transaction numbers are only allowed on a replica set member", 20)
+
+
+def test_run_transaction_remembers_missing_transaction_support(dbm):
+    dbm.client_server1 = client = StandaloneClient()
+    sessions_seen = []
+    for _ in range(3):
+        assert dbm.run_transaction("CN1", lambda s: sessions_seen.append(s) or "done") == "done"
+    assert sessions_seen == [None, None, None]
+    assert client.sessions == 1
+
+
+def test_run_transaction_reraises_other_failures(dbm):
+    class FailingSession(StandaloneSession):
+        def with_transaction(self, callback):
+            raise OperationFailure("WriteConflict", 112)
+
+    class FailingClient(StandaloneClient):
+        def start_session(self):
+            return FailingSession()
+
+    dbm.client_server1 = FailingClient()
+    with pytest.raises(OperationFailure):
+        dbm.run_transaction("CN1", lambda s: None)
+
+
+def test_seed_demo_data_leaves_used_collections_alone(dbm):
+    dbm.init_schema()
+    dbm.seed_demo_data()
+    dbm.db_server3["Nhanvien"].delete_one({"MANV": "NV01"})
+    dbm.db_server1["Inventory"].delete_one({"MAKHO": "KHO1", "MAHANG": "VT02"})
+    dbm.db_server2["Inventory"].delete_many({})
+    dbm.seed_demo_data()
+    assert dbm.db_server3["Nhanvien"].distinct("MANV") == ["NV02"]
+    assert sorted(dbm.db_server1["Inventory"].distinct("MAHANG")) == ["VT01", "VT03"]
+    # An emptied collection is seeded again
+    assert dbm.db_server2["Inventory"].count_documents({}) == 3
+
+
+def test_pool_options_come_from_the_environment(monkeypatch):
+    monkeypatch.setenv("MONGODB_MAX_POOL", "7")
+    monkeypatch.setenv("MONGODB_MIN_POOL", "lots")
+    with pytest.warns(RuntimeWarning, match="MONGODB_MIN_POOL"):
+        dbm = DatabaseManager(pool_options={"maxIdleTimeMS": 1000})
+    assert dbm.pool_options["maxPoolSize"] == 7
+    assert dbm.pool_options["minPoolSize"] == POOL_OPTIONS["minPoolSize"]
+    assert dbm.pool_options["maxIdleTimeMS"] == 1000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(database.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_get_ref_serves_repeated_reads_from_memory(dbm, clock):
+    kho = dbm.db_server3["Kho"]
+    kho.insert_one({"MAKHO": "K1", "MACN": "CN1"})
+    first = dbm.get_ref("Kho")
+    kho.insert_one({"MAKHO": "K2", "MACN": "CN2"})
+    assert dbm.get_ref("Kho") is first
+    assert first == [{"MAKHO": "K1", "MACN": "CN1"}]
+
+
+def test_invalidate_ref_forces_a_fresh_read(dbm, clock):
+    kho = dbm.db_server3["Kho"]
+    dbm.get_ref("Kho")
+    kho.insert_one({"MAKHO": "K1", "MACN": "CN1"})
+    dbm.invalidate_ref("Kho")
+    assert [d["MAKHO"] for d in dbm.get_ref("Kho")] == ["K1"]
+
+
+def test_get_ref_sees_other_writers_after_the_ttl(dbm, clock):
+    dbm.get_ref("Vattu")
+    # Written by another process: nothing here invalidates the cache
+    dbm.db_server3["Vattu"].insert_one({"MAHANG": "VT09"})
+    clock[0] += database.REF_TTL - 1
+    assert dbm.get_ref("Vattu") == []
+    clock[0] += 1
+    assert dbm.get_ref("Vattu") == [{"MAHANG": "VT09"}]
+
+
+def test_get_ref_does_not_store_a_read_that_raced_a_write(dbm, clock, monkeypatch):
+    vattu = dbm.db_server3["Vattu"]
+    real_find = type(vattu).find
+
+    def find_then_write(col, *args, **kwargs):
+        cursor = list(real_find(col, *args, **kwargs))
+        vattu.insert_one({"MAHANG": "VT09"})
+        dbm.invalidate_ref("Vattu")
+        return cursor
+
+    monkeypatch.setattr(type(vattu), "find", find_then_write)
+    assert dbm.get_ref("Vattu") == []
+    monkeypatch.setattr(type(vattu), "find", real_find)
+    assert dbm.get_ref("Vattu") == [{"MAHANG": "VT09"}]
+
+
+def test_get_ref_refuses_uncached_collections(dbm):
+    with pytest.raises(ValueError):
+        dbm.get_ref("users")
+
+
+LAZY = {"connect": False}
+
+
+@pytest.fixture
+def registry():
+    """Restore the shared client registry and close the clients a test added."""
+    saved = dict(DatabaseManager._client_registry)
+    yield
+    with DatabaseManager._registry_lock:
+        added = [c for k, c in DatabaseManager._client_registry.items() if k not in saved]
+        DatabaseManager._client_registry.clear()
+        DatabaseManager._client_registry.update(saved)
+    for client in added:
+        client.close()
+
+
+def test_same_uri_and_options_share_one_client(registry):
+    uri = "mongodb://registry-a.invalid:27017"
+    first = DatabaseManager(uri, uri, "mongodb://registry-b.invalid:27017", pool_options=LAZY)
+    second = DatabaseManager(uri, pool_options=LAZY)
+    assert first.client_server1 is first.client_server2 is second.client_server1
+    assert first.client_server3 is not first.client_server1
+
+
+def test_different_pool_options_get_their_own_client(registry):
+    uri = "mongodb://registry-c.invalid:27017"
+    small = DatabaseManager(uri, pool_options={**LAZY, "maxPoolSize": 3, "minPoolSize": 1})
+    default = DatabaseManager(uri, pool_options=LAZY)
+    assert small.client_server1 is not default.client_server1
+    assert small.client_server1.options.pool_options.max_pool_size == 3
+
+
+def test_in_memory_clients_are_per_manager(dbm):
+    other = DatabaseManager()
+    assert dbm.client_server1 is dbm.client_server2 is dbm.client_server3
+    assert other.client_server1 is not dbm.client_server1
+
+
+@pytest.mark.parametrize(
+    "branch, code",
+    [(Branch.CN1, "CN1"), ("CN1", "CN1"), ("cn1", "CN1"), (Branch.CN2, "CN2"), ("Cn2", "CN2"), (None, None)],
+)
+@pytest.mark.parametrize("name", ["CTPX", "Inventory", "Kho", "users"])
+def test_memoized_handles_match_resolution(dbm, branch, code, name):
+    if code is None and name in {"CTPX", "Inventory"}:
+        with pytest.raises(ValueError):
+            dbm.get_collection(branch, name)
+        return
+    handle = dbm.get_collection(branch, name)
+    assert dbm.get_collection(branch, name) is handle
+    assert handle.full_name == dbm._resolve_collection(code, name).full_name
+
+
+def test_branch_spellings_share_one_handle(dbm):
+    assert dbm.get_collection("cn2", "CTPN") is dbm.get_collection(Branch.CN2, "CTPN")
+    assert dbm.get_collection("CN1", "CTPN") is not dbm.get_collection("CN2", "CTPN")
+    with pytest.raises(ValueError):
+        dbm.get_collection("CN3", "CTPN")
+
+
+class FakeStream:
+    def __init__(self, changes):
+        self.changes = changes
+
+    def __enter__(self):
+        return iter(self.changes)
+
+    def __exit__(self, *exc):
+        return False
+
+
+class WatchedDb:
+    """Database whose change streams play back scripted changes or errors."""
+
+    name = "watched"
+
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.pipelines = []
+
+    def watch(self, pipeline):
+        self.pipelines.append(pipeline)
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return FakeStream([{"ns": {"db": self.name, "coll": name}} for name in stream])
+
+
+def test_watch_changes_is_a_no_op_in_memory(dbm):
+    assert dbm.watch_changes(dbm.db_server1, ["PhieuXuat"], lambda name: None) is None
+
+
+def test_watch_changes_dispatches_and_reopens_the_stream(dbm, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(database.time, "sleep", sleeps.append)
+    db = WatchedDb(
+        ["Kho", "Vattu"],
+        AutoReconnect("connection closed"),
+        AutoReconnect("connection closed"),
+        ["Kho"],
+        OperationFailure("only supported on replica sets", database.CHANGE_STREAM_NOT_SUPPORTED),
+    )
+    seen = []
+
+    def on_change(name):
+        seen.append(name)
+        if name == "Vattu":
+            raise RuntimeError("handler bug")
+
+    dbm.watch_changes(db, ["Kho", "Vattu"], on_change).join(5)
+    assert seen == ["Kho", "Vattu", "Kho"]
+    assert db.pipelines[0] == [{"$match": {"ns.coll": {"$in": ["Kho", "Vattu"]}}}]
+    # Backs off while the stream keeps failing, and starts over once it opens
+    assert sleeps == [1, 2, 4, 1]
+    assert db.streams == []
+
+
+def test_gather_returns_results_by_name(dbm):
+    ready = threading.Event()
+    results = dbm.gather({
+        "slow": lambda: ready.wait(5) and "slow",
+        "fast": lambda: ready.set() or "fast",
+    })
+    assert results == {"slow": "slow", "fast": "fast"}
+    assert list(results) == ["slow", "fast"]
+
+
+def test_gather_reraises_a_failure(dbm):
+    def fail():
+        raise OperationFailure("boom")
+
+    with pytest.raises(OperationFailure, match="boom"):
+        dbm.gather({"ok": lambda: 1, "bad": fail})
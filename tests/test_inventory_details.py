@@ -11,187 +11,269 @@ except Exception:
         DuplicateKeyError = Exception
 
 
+def _take_stock(inv_col, makho, mahang, qty, session=None):
+    # Check and decrement in one conditional update; nothing matches when short
+    res = inv_col.update_one(
+        {"MAKHO": makho, "MAHANG": mahang, "SOLUONG": {"$gte": qty}},
+        {"$inc": {"SOLUONG": -qty}},
+        session=session,
+    )
+    if res.matched_count == 0:
+        raise ValueError("insufficient stock")
+
+
+# Each helper runs its detail and Inventory writes through run_transaction so
+# they commit together; without transaction support (mongomock) the explicit
+# compensation keeps the stock consistent instead.
+
+
 def add_order_detail(dbm, branch, order_id, makho, mahang, qty, price):
     ct_col = dbm.get_collection(branch, "CTDDH")
     inv_col = dbm.get_collection(branch, "Inventory")
-    if ct_col.find_one({"MasoDDH": order_id, "MAHANG": mahang}):
-        raise ValueError("duplicate detail")
-    inv = inv_col.find_one({"MAKHO": makho, "MAHANG": mahang})
-    available = inv.get("SOLUONG", 0) if inv else 0
-    if qty > available:
-        raise ValueError("insufficient stock")
-    ct_col.insert_one({
-        "MasoDDH": order_id,
-        "MAHANG": mahang,
-        "SOLUONG": qty,
-        "DONGIA": price,
-    })
-    inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -qty}})
+
+    def write(session):
+        # Insert the line first: a duplicate then fails before any stock moved
+        try:
+            ct_col.insert_one({
+                "MasoDDH": order_id,
+                "MAHANG": mahang,
+                "SOLUONG": qty,
+                "DONGIA": price,
+            }, session=session)
+        except DuplicateKeyError:
+            raise ValueError("duplicate detail") from None
+        try:
+            _take_stock(inv_col, makho, mahang, qty, session)
+        except ValueError:
+            if session is None:
+                # No transaction to roll back the line
+                ct_col.delete_one({"MasoDDH": order_id, "MAHANG": mahang})
+            raise
+
+    dbm.run_transaction(branch, write)
 
 
 def edit_order_detail(dbm, branch, order_id, makho, mahang, new_qty, new_price):
     ct_col = dbm.get_collection(branch, "CTDDH")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MasoDDH": order_id, "MAHANG": mahang})
-    diff = new_qty - detail["SOLUONG"]
-    inv = inv_col.find_one({"MAKHO": makho, "MAHANG": mahang})
-    available = inv.get("SOLUONG", 0) if inv else 0
-    if diff > 0 and diff > available:
-        raise ValueError("insufficient stock")
-    ct_col.update_one(
-        {"MasoDDH": order_id, "MAHANG": mahang},
-        {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-    )
-    if diff != 0:
-        inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -diff}})
+
+    def write(session):
+        detail = ct_col.find_one(
+            {"MasoDDH": order_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        diff = new_qty - detail["SOLUONG"]
+        if diff > 0:
+            _take_stock(inv_col, makho, mahang, diff, session)
+        elif diff < 0:
+            inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -diff}}, session=session)
+        ct_col.update_one(
+            {"MasoDDH": order_id, "MAHANG": mahang},
+            {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
+            session=session,
+        )
+
+    dbm.run_transaction(branch, write)
 
 
 def delete_order_detail(dbm, branch, order_id, makho, mahang):
     ct_col = dbm.get_collection(branch, "CTDDH")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MasoDDH": order_id, "MAHANG": mahang})
-    ct_col.delete_one({"MasoDDH": order_id, "MAHANG": mahang})
-    inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": detail["SOLUONG"]}})
+
+    def write(session):
+        detail = ct_col.find_one(
+            {"MasoDDH": order_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        ct_col.delete_one({"MasoDDH": order_id, "MAHANG": mahang}, session=session)
+        inv_col.update_one(
+            {"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": detail["SOLUONG"]}}, session=session
+        )
+
+    dbm.run_transaction(branch, write)
 
 
 def add_export_detail(dbm, branch, px_id, makho, mahang, qty, price):
     ct_col = dbm.get_collection(branch, "CTPX")
     inv_col = dbm.get_collection(branch, "Inventory")
-    if ct_col.find_one({"MAPX": px_id, "MAHANG": mahang}):
-        raise ValueError("duplicate detail")
-    inv = inv_col.find_one({"MAKHO": makho, "MAHANG": mahang})
-    available = inv.get("SOLUONG", 0) if inv else 0
-    if qty > available:
-        raise ValueError("insufficient stock")
-    ct_col.insert_one({
-        "MAPX": px_id,
-        "MAHANG": mahang,
-        "SOLUONG": qty,
-        "DONGIA": price,
-    })
-    inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -qty}})
+
+    def write(session):
+        # Insert the line first: a duplicate then fails before any stock moved
+        try:
+            ct_col.insert_one({
+                "MAPX": px_id,
+                "MAHANG": mahang,
+                "SOLUONG": qty,
+                "DONGIA": price,
+            }, session=session)
+        except DuplicateKeyError:
+            raise ValueError("duplicate detail") from None
+        try:
+            _take_stock(inv_col, makho, mahang, qty, session)
+        except ValueError:
+            if session is None:
+                # No transaction to roll back the line
+                ct_col.delete_one({"MAPX": px_id, "MAHANG": mahang})
+            raise
+
+    dbm.run_transaction(branch, write)
 
 
 def edit_export_detail(dbm, branch, px_id, makho, mahang, new_qty, new_price):
     ct_col = dbm.get_collection(branch, "CTPX")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MAPX": px_id, "MAHANG": mahang})
-    diff = new_qty - detail["SOLUONG"]
-    inv = inv_col.find_one({"MAKHO": makho, "MAHANG": mahang})
-    available = inv.get("SOLUONG", 0) if inv else 0
-    if diff > 0 and diff > available:
-        raise ValueError("insufficient stock")
-    ct_col.update_one(
-        {"MAPX": px_id, "MAHANG": mahang},
-        {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-    )
-    if diff != 0:
-        inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -diff}})
+
+    def write(session):
+        detail = ct_col.find_one(
+            {"MAPX": px_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        diff = new_qty - detail["SOLUONG"]
+        if diff > 0:
+            _take_stock(inv_col, makho, mahang, diff, session)
+        elif diff < 0:
+            inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -diff}}, session=session)
+        ct_col.update_one(
+            {"MAPX": px_id, "MAHANG": mahang},
+            {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
+            session=session,
+        )
+
+    dbm.run_transaction(branch, write)
 
 
 def delete_export_detail(dbm, branch, px_id, makho, mahang):
     ct_col = dbm.get_collection(branch, "CTPX")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MAPX": px_id, "MAHANG": mahang})
-    ct_col.delete_one({"MAPX": px_id, "MAHANG": mahang})
-    inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": detail["SOLUONG"]}})
+
+    def write(session):
+        detail = ct_col.find_one(
+            {"MAPX": px_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        ct_col.delete_one({"MAPX": px_id, "MAHANG": mahang}, session=session)
+        inv_col.update_one(
+            {"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": detail["SOLUONG"]}}, session=session
+        )
+
+    dbm.run_transaction(branch, write)
 
 
 def add_import_detail(dbm, branch, pn_id, makho, mahang, qty, price):
     ct_col = dbm.get_collection(branch, "CTPN")
     inv_col = dbm.get_collection(branch, "Inventory")
-    if ct_col.find_one({"MAPN": pn_id, "MAHANG": mahang}):
-        raise ValueError("duplicate detail")
-    ct_col.insert_one({"MAPN": pn_id, "MAHANG": mahang, "SOLUONG": qty, "DONGIA": price})
-    inv_col.update_one(
-        {"MAKHO": makho, "MAHANG": mahang},
-        {"$inc": {"SOLUONG": qty}},
-        upsert=True,
-    )
+
+    def write(session):
+        try:
+            ct_col.insert_one({"MAPN": pn_id, "MAHANG": mahang, "SOLUONG": qty, "DONGIA": price}, session=session)
+        except DuplicateKeyError:
+            raise ValueError("duplicate detail") from None
+        inv_col.update_one(
+            {"MAKHO": makho, "MAHANG": mahang},
+            {"$inc": {"SOLUONG": qty}},
+            upsert=True,
+            session=session,
+        )
+
+    dbm.run_transaction(branch, write)
 
 
 def edit_import_detail(dbm, branch, pn_id, makho, mahang, new_qty, new_price):
     ct_col = dbm.get_collection(branch, "CTPN")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MAPN": pn_id, "MAHANG": mahang})
-    diff = new_qty - detail["SOLUONG"]
-    ct_col.update_one(
-        {"MAPN": pn_id, "MAHANG": mahang},
-        {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
-    )
-    if diff != 0:
-        inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": diff}})
+
+    def write(session):
+        detail = ct_col.find_one(
+            {"MAPN": pn_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        diff = new_qty - detail["SOLUONG"]
+        ct_col.update_one(
+            {"MAPN": pn_id, "MAHANG": mahang},
+            {"$set": {"SOLUONG": new_qty, "DONGIA": new_price}},
+            session=session,
+        )
+        if diff != 0:
+            inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": diff}}, session=session)
+
+    dbm.run_transaction(branch, write)
 
 
 def delete_import_detail(dbm, branch, pn_id, makho, mahang):
     ct_col = dbm.get_collection(branch, "CTPN")
     inv_col = dbm.get_collection(branch, "Inventory")
-    detail = ct_col.find_one({"MAPN": pn_id, "MAHANG": mahang})
-    ct_col.delete_one({"MAPN": pn_id, "MAHANG": mahang})
-    inv_col.update_one({"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -detail["SOLUONG"]}})
 
+    def write(session):
+        detail = ct_col.find_one(
+            {"MAPN": pn_id, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1}, session=session
+        )
+        ct_col.delete_one({"MAPN": pn_id, "MAHANG": mahang}, session=session)
+        inv_col.update_one(
+            {"MAKHO": makho, "MAHANG": mahang}, {"$inc": {"SOLUONG": -detail["SOLUONG"]}}, session=session
+        )
 
-@pytest.fixture
-def dbm():
+    dbm.run_transaction(branch, write)
+
+
+def _stock(inv_col, makho, mahang):
+    return inv_col.find_one({"MAKHO": makho, "MAHANG": mahang}, {"_id": 0, "SOLUONG": 1})["SOLUONG"]
+
+
+BRANCH_COLLECTIONS = ("DatHang", "CTDDH", "PhieuNhap", "CTPN", "PhieuXuat", "CTPX", "Inventory")
+
+
+@pytest.fixture(scope="session")
+def shared_dbm():
+    # Clients and indexes are built once; reference data is never modified by tests
     dbm = DatabaseManager()
     dbm.init_schema()
-    dbm.seed_demo_data()
     return dbm
 
 
-def _prepare_order(dbm):
-    branch = "CN1"
-    makho = "KHO1"
-    dathang = dbm.get_collection(branch, "DatHang")
-    dathang.insert_one({
-        "MasoDDH": "DH001",
-        "NGAY": "2023-01-01",
-        "NhaCC": "NCC",
-        "MANV": "NV01",
-        "MAKHO": makho,
-    })
+@pytest.fixture
+def dbm(shared_dbm):
+    # Empty the branch collections and restore the demo stock for every test
+    for name in BRANCH_COLLECTIONS:
+        shared_dbm.db_server1[name].delete_many({})
+        shared_dbm.db_server2[name].delete_many({})
+    shared_dbm.seed_demo_data()
+    return shared_dbm
+
+
+# Header document each detail test hangs its lines on, by collection
+HEADERS = {
+    "DatHang": {"MasoDDH": "DH001", "NGAY": "2023-01-01", "NhaCC": "NCC", "MANV": "NV01"},
+    "PhieuXuat": {"MAPX": "PX001", "NGAY": "2023-01-01", "HOTENKH": "A", "MANV": "NV01"},
+    "PhieuNhap": {"MAPN": "PN001", "NGAY": "2023-01-01", "MasoDDH": "DHX", "MANV": "NV01"},
+}
+
+
+def _prepare(dbm, *names, branch="CN1", makho="KHO1"):
+    # Each header lives in its own collection, one insert per collection
+    for name in names:
+        dbm.get_collection(branch, name).insert_one({**HEADERS[name], "MAKHO": makho})
     return branch, makho
 
 
+def _prepare_all(dbm, branch="CN1", makho="KHO1"):
+    return _prepare(dbm, *HEADERS, branch=branch, makho=makho)
+
+
+def _prepare_order(dbm):
+    return _prepare(dbm, "DatHang")
+
+
 def _prepare_export(dbm):
-    branch = "CN1"
-    makho = "KHO1"
-    phieuxuat = dbm.get_collection(branch, "PhieuXuat")
-    phieuxuat.insert_one({
-        "MAPX": "PX001",
-        "NGAY": "2023-01-01",
-        "HOTENKH": "A",
-        "MANV": "NV01",
-        "MAKHO": makho,
-    })
-    return branch, makho
+    return _prepare(dbm, "PhieuXuat")
 
 
 def _prepare_import(dbm):
-    branch = "CN1"
-    makho = "KHO1"
-    phieunhap = dbm.get_collection(branch, "PhieuNhap")
-    phieunhap.insert_one({
-        "MAPN": "PN001",
-        "NGAY": "2023-01-01",
-        "MasoDDH": "DHX",
-        "MANV": "NV01",
-        "MAKHO": makho,
-    })
-    return branch, makho
+    return _prepare(dbm, "PhieuNhap")
 
 
 def test_add_order_detail_insufficient_stock(dbm):
     branch, makho = _prepare_order(dbm)
     inv_col = dbm.get_collection(branch, "Inventory")
-    available = inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"]
+    available = _stock(inv_col, makho, "VT01")
     with pytest.raises(ValueError):
         add_order_detail(dbm, branch, "DH001", makho, "VT01", available + 1, 1000)
     assert dbm.get_collection(branch, "CTDDH").count_documents({}) == 0
-    assert (
-        inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"]
-        == available
-    )
+    assert _stock(inv_col, makho, "VT01") == available
 
 
 def test_edit_order_detail_insufficient_stock(dbm):
@@ -202,20 +284,17 @@ def test_edit_order_detail_insufficient_stock(dbm):
         edit_order_detail(dbm, branch, "DH001", makho, "VT01", 200, 1000)
     detail = dbm.get_collection(branch, "CTDDH").find_one({"MasoDDH": "DH001", "MAHANG": "VT01"})
     assert detail["SOLUONG"] == 10
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"] == 90
+    assert _stock(inv_col, makho, "VT01") == 90
 
 
 def test_add_export_detail_insufficient_stock(dbm):
     branch, makho = _prepare_export(dbm)
     inv_col = dbm.get_collection(branch, "Inventory")
-    available = inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"]
+    available = _stock(inv_col, makho, "VT01")
     with pytest.raises(ValueError):
         add_export_detail(dbm, branch, "PX001", makho, "VT01", available + 5, 1000)
     assert dbm.get_collection(branch, "CTPX").count_documents({}) == 0
-    assert (
-        inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"]
-        == available
-    )
+    assert _stock(inv_col, makho, "VT01") == available
 
 
 def test_edit_export_detail_insufficient_stock(dbm):
@@ -226,23 +305,21 @@ def test_edit_export_detail_insufficient_stock(dbm):
         edit_export_detail(dbm, branch, "PX001", makho, "VT01", 200, 1000)
     detail = dbm.get_collection(branch, "CTPX").find_one({"MAPX": "PX001", "MAHANG": "VT01"})
     assert detail["SOLUONG"] == 10
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT01"})["SOLUONG"] == 90
+    assert _stock(inv_col, makho, "VT01") == 90
 
 
 def test_duplicate_detail_line_prevention(dbm):
-    branch, makho = _prepare_order(dbm)
+    branch, makho = _prepare_all(dbm)
     ctddh = dbm.get_collection(branch, "CTDDH")
     ctddh.insert_one({"MasoDDH": "DH001", "MAHANG": "VT02", "SOLUONG": 5, "DONGIA": 1})
     with pytest.raises(DuplicateKeyError):
         ctddh.insert_one({"MasoDDH": "DH001", "MAHANG": "VT02", "SOLUONG": 1, "DONGIA": 1})
 
-    branch, makho = _prepare_import(dbm)
     ctpn = dbm.get_collection(branch, "CTPN")
     ctpn.insert_one({"MAPN": "PN001", "MAHANG": "VT02", "SOLUONG": 5, "DONGIA": 1})
     with pytest.raises(DuplicateKeyError):
         ctpn.insert_one({"MAPN": "PN001", "MAHANG": "VT02", "SOLUONG": 1, "DONGIA": 1})
 
-    branch, makho = _prepare_export(dbm)
     ctpx = dbm.get_collection(branch, "CTPX")
     ctpx.insert_one({"MAPX": "PX001", "MAHANG": "VT02", "SOLUONG": 5, "DONGIA": 1})
     with pytest.raises(DuplicateKeyError):
@@ -250,29 +327,27 @@ def test_duplicate_detail_line_prevention(dbm):
 
 
 def test_inventory_rollback_on_edit_delete(dbm):
-    branch, makho = _prepare_order(dbm)
+    branch, makho = _prepare_all(dbm)
     add_order_detail(dbm, branch, "DH001", makho, "VT03", 10, 1)
     inv_col = dbm.get_collection(branch, "Inventory")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 90
+    assert _stock(inv_col, makho, "VT03") == 90
     edit_order_detail(dbm, branch, "DH001", makho, "VT03", 5, 1)
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 95
+    assert _stock(inv_col, makho, "VT03") == 95
     delete_order_detail(dbm, branch, "DH001", makho, "VT03")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 100
+    assert _stock(inv_col, makho, "VT03") == 100
 
-    branch, makho = _prepare_import(dbm)
     add_import_detail(dbm, branch, "PN001", makho, "VT03", 20, 1)
     inv_col = dbm.get_collection(branch, "Inventory")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 120
+    assert _stock(inv_col, makho, "VT03") == 120
     edit_import_detail(dbm, branch, "PN001", makho, "VT03", 30, 1)
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 130
+    assert _stock(inv_col, makho, "VT03") == 130
     delete_import_detail(dbm, branch, "PN001", makho, "VT03")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 100
+    assert _stock(inv_col, makho, "VT03") == 100
 
-    branch, makho = _prepare_export(dbm)
     add_export_detail(dbm, branch, "PX001", makho, "VT03", 10, 1)
     inv_col = dbm.get_collection(branch, "Inventory")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 90
+    assert _stock(inv_col, makho, "VT03") == 90
     edit_export_detail(dbm, branch, "PX001", makho, "VT03", 5, 1)
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 95
+    assert _stock(inv_col, makho, "VT03") == 95
     delete_export_detail(dbm, branch, "PX001", makho, "VT03")
-    assert inv_col.find_one({"MAKHO": makho, "MAHANG": "VT03"})["SOLUONG"] == 100
+    assert _stock(inv_col, makho, "VT03") == 100
@@ -0,0 +1,79 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import pytest
+import reports
+from database import DatabaseManager
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.init_schema()
+    dbm.seed_demo_data()
+    return dbm
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(reports.time, "monotonic", lambda: now[0])
+    reports.invalidate()
+    return now
+
+
+def _issue(dbm, mapx, branch="CN1"):
+    dbm.get_collection(branch, "PhieuXuat").insert_one({"MAPX": mapx})
+
+
+def _revenue(dbm):
+    frame = reports.revenue_by_branch(dbm)
+    return dict(zip(frame["branch"], frame["revenue"]))
+
+
+def test_reports_are_cached_for_the_ttl(dbm, clock):
+    assert _revenue(dbm) == {"CN1": 0, "CN2": 0}
+    _issue(dbm, "PX1")
+    clock[0] += reports.REPORT_TTL - 1
+    assert _revenue(dbm) == {"CN1": 0, "CN2": 0}
+    clock[0] += 1
+    assert _revenue(dbm) == {"CN1": 1, "CN2": 0}
+
+
+def test_invalidate_drops_cached_reports(dbm, clock):
+    assert _revenue(dbm)["CN2"] == 0
+    _issue(dbm, "PX1", "CN2")
+    reports.invalidate()
+    assert _revenue(dbm)["CN2"] == 1
+
+
+def test_callers_get_a_copy(dbm, clock):
+    first = reports.inventory_by_branch(dbm)
+    first.loc[0, "inventory"] = 999
+    first["extra"] = 1
+    second = reports.inventory_by_branch(dbm)
+    assert list(second.columns) == ["branch", "inventory"]
+    assert second["inventory"].tolist() == [0, 0]
+
+
+def test_managers_do_not_share_reports(dbm, clock):
+    other = DatabaseManager()
+    other.init_schema()
+    other.seed_demo_data()
+    _issue(other, "PX1")
+    assert _revenue(dbm)["CN1"] == 0
+    assert _revenue(other)["CN1"] == 1
+
+
+def test_a_report_that_raced_a_write_is_not_stored(dbm, clock, monkeypatch):
+    real_count = reports._count_by_branch
+
+    def count_then_write(*args):
+        counts = real_count(*args)
+        _issue(dbm, "PX1")
+        reports.invalidate()
+        return counts
+
+    monkeypatch.setattr(reports, "_count_by_branch", count_then_write)
+    assert _revenue(dbm)["CN1"] == 0
+    monkeypatch.setattr(reports, "_count_by_branch", real_count)
+    assert _revenue(dbm)["CN1"] == 1